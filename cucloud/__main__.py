@@ -3,6 +3,7 @@ import logging
 import os
 import sys
 import providers
+from . import accounts as cucloud_accounts
 from . import __version__
 
 __author__ = 'emg33'
@@ -20,8 +21,25 @@ def _create_parser():
     parser.add_argument('--config-list', help='List configuration values', action='store_true')
     parser.add_argument('--config-set', metavar=('key', 'value'), nargs=2, help='Set a configuration key + value')
     parser.add_argument('--config-unset', metavar=('key'), nargs=1, help='Unset a configuration key')
+    parser.add_argument('--config-revision', metavar=('revision'), type=int,
+                        help='Only set/unset if the configuration revision still matches')
     parser.add_argument('--config-import', help='Import JSON configuration', action='store_true')
     parser.add_argument('--config-export', help='Export JSON configuration', action='store_true')
+    parser.add_argument('--config-export-all', help='Export JSON configuration of every env of the profile',
+                        action='store_true')
+    parser.add_argument('--config-export-bundle', metavar=('profile:env'), nargs='+',
+                        help='Export JSON configuration of many profile:env pairs')
+    parser.add_argument('--config-import-bundle', help='Import multi profile JSON configuration bundle',
+                        action='store_true')
+
+    parser.add_argument('--accounts', metavar=('profile:env'), nargs='+',
+                        help='Run the action for many profile:env pairs in parallel worker processes')
+    parser.add_argument('--account-workers', metavar=('workers'), type=int, default=4,
+                        help='Number of profile:env pairs run at once with --accounts')
+
+    parser.add_argument('--stats', help='Print API call statistics at exit', action='store_true')
+    parser.add_argument('--stats-json', metavar=('file'), type=str,
+                        help='Write API call statistics as JSON to file at exit')
 
     parser.add_argument('--version', help='Display cucloud version number', action='store_true')
 
@@ -62,6 +80,15 @@ def main(args=None):
     else:
         provider_name = 'aws'
 
+    if args.accounts:
+        if args.stats or args.stats_json:
+            # statistics are collected per worker process
+            parser.error('--stats and --stats-json are not supported with --accounts')
+        return run_accounts(provider_name, args)
+
+    # bundles name their own profile:env pairs, the active profile and env only select the AWS credentials
+    bundle = args.config_export_bundle or args.config_import_bundle
+
     # profile selection: prioritize args over E=CUCLOUD_PROFILE
     if args.profile:
         profile_name = args.profile
@@ -69,6 +96,9 @@ def main(args=None):
     elif os.environ.has_key('CUCLOUD_PROFILE'):
         profile_name = os.environ.get('CUCLOUD_PROFILE')
         logging.info('Using cloud profile "%s" set in env', profile_name)
+    elif bundle:
+        profile_name = 'default'
+        logging.info('Using default cloud profile for bundle')
     else:
         logging.fatal('No cloud profile selected')
         raise Exception('Cloud profile must be configured or set via command line')
@@ -80,13 +110,77 @@ def main(args=None):
     elif os.environ.has_key('CUCLOUD_ENV'):
         env_name = os.environ.get('CUCLOUD_ENV')
         logging.info('Using profile environment "%s" set via arguments', env_name)
+    elif bundle or args.config_export_all:
+        # every env of the profile is exported, none needs to be active
+        env_name = 'default'
+        logging.info('Using default profile environment for bundle or export of every env')
     else:
         logging.fatal('No profile environment selected')
         raise Exception('Cloud profile environment must be configured or set via command line')
 
     provider = providers.get_provider(provider_name, profile_name, env_name)
 
-    return provider.handle_args(args)
+    try:
+        return provider.handle_args(args)
+    finally:
+        if args.stats or args.stats_json:
+            write_stats(provider, args.stats, args.stats_json)
+
+
+def _account_argv(argv):
+    """
+    argv without the options selecting profiles and accounts, those are set per account by the workers
+    """
+    # option -> whether it takes more than one value
+    account_options = {'--accounts': True, '--account-workers': False, '--profile': False, '--env': False}
+
+    result = []
+    skipping = None
+    for arg in argv:
+        name = arg.split('=', 1)[0]
+        if name in account_options:
+            skipping = name if '=' not in arg else None
+            continue
+        if skipping and not arg.startswith('-'):
+            if not account_options[skipping]:
+                skipping = None
+            continue
+        skipping = None
+        result.append(arg)
+
+    return result
+
+
+def run_accounts(provider_name, args):
+    """
+    run the command line action for every --accounts profile:env pair, printing each account's output as it completes
+    """
+    accounts = cucloud_accounts.parse_accounts(args.accounts)
+    argv = _account_argv(sys.argv[1:])
+
+    failed = 0
+    for result in cucloud_accounts.map_accounts_cli(argv, accounts, max_workers=args.account_workers,
+                                                    provider_name=provider_name):
+        print "==> " + result.profile_name + ":" + result.env_name + " (" + "%.1f" % result.seconds + "s)"
+        sys.stdout.write(result.output)
+        if result.error:
+            failed += 1
+            sys.stderr.write(result.profile_name + ":" + result.env_name + " failed: " + result.error + "\n")
+
+    return failed == 0
+
+
+def write_stats(provider, summary, json_path):
+    stats = getattr(provider, 'stats', None)
+    if stats is None:
+        logging.warning('Provider does not collect API call statistics')
+        return
+
+    if summary:
+        stats.print_summary(sys.stderr)
+    if json_path:
+        with open(json_path, 'w') as f:
+            stats.write_json(f)
 
 
 # this allows us to call this both via python -m cucloud
@@ -0,0 +1,141 @@
+import StringIO
+import pickle
+import sys
+import time
+import traceback
+from concurrent import futures
+
+__author__ = 'emg33'
+
+
+class AccountResult(object):
+    """
+    Outcome of an action run for one (profile, env) pair in a worker process.
+    Exceptions are reported as text, as not every exception can be sent back from a worker.
+    """
+
+    def __init__(self, profile_name, env_name, result=None, error=None, output='', seconds=0.0):
+        self.profile_name = profile_name
+        self.env_name = env_name
+        self.result = result
+        self.error = error
+        self.output = output
+        self.seconds = seconds
+
+    def __repr__(self):
+        return 'AccountResult(%s:%s, error=%r)' % (self.profile_name, self.env_name, self.error)
+
+
+def parse_accounts(values):
+    """
+    :param values: list[str] profile:env pairs
+    :return: list[tuple] of (profile, env)
+    """
+    accounts = []
+    for value in values:
+        if ':' not in value:
+            raise ValueError('Expected profile:env', value)
+        accounts.append(tuple(value.split(':', 1)))
+    return accounts
+
+
+def _run_account(profile_name, env_name, action, provider_name, named_profile, dry_run):
+    # runs in the worker process, its provider (and named profile default session) never leaves it
+    from cucloud import providers
+
+    started = time.time()
+    stdout = sys.stdout
+    sys.stdout = output = StringIO.StringIO()
+    try:
+        provider = providers.get_provider(provider_name, profile_name, env_name,
+                                          dry_run=dry_run, named_profile=named_profile)
+        result = action(provider)
+        # an unpicklable result would never make it back to the parent
+        pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        error = None
+    except Exception:
+        result = None
+        error = traceback.format_exc()
+    finally:
+        sys.stdout = stdout
+
+    return AccountResult(profile_name, env_name, result=result, error=error, output=output.getvalue(),
+                         seconds=time.time() - started)
+
+
+class _CallableAction(object):
+    # picklable partial: func(provider, *args, **kwargs)
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self, provider):
+        return self.func(provider, *self.args, **self.kwargs)
+
+
+class _CliAction(object):
+    # picklable command line action: the cucloud arguments handled by the account's provider
+
+    def __init__(self, argv):
+        self.argv = argv
+
+    def __call__(self, provider):
+        from cucloud.__main__ import _create_parser
+
+        args = _create_parser().parse_args(self.argv)
+        return provider.handle_args(args)
+
+
+def map_accounts(func, accounts, max_workers=4, provider_name='aws', named_profile=True, dry_run=False,
+                 args=(), kwargs=None):
+    """
+    Run func(provider, *args, **kwargs) for every (profile, env) pair in a pool of worker processes,
+    each with its own provider and session. Results are yielded as the accounts complete.
+
+    func must be a module level function, and it and its result must be picklable.
+
+    :param accounts: list[tuple] of (profile, env)
+    :param max_workers: int accounts run at once
+    :param named_profile: bool profiles are AWS named profiles, usually one per account
+    :return: generator of AccountResult
+    """
+    return _map_accounts(_CallableAction(func, args, kwargs or {}), accounts, max_workers,
+                         provider_name, named_profile, dry_run)
+
+
+def map_accounts_cli(argv, accounts, max_workers=4, provider_name='aws', named_profile=True, dry_run=False):
+    """
+    Run a cucloud command line action, e.g. ['--config-export'], for every (profile, env) pair in a pool
+    of worker processes. Printed output is captured per account and returned in AccountResult.output.
+
+    :param argv: list[str] cucloud arguments, without --profile/--env
+    :return: generator of AccountResult
+    """
+    return _map_accounts(_CliAction(list(argv)), accounts, max_workers, provider_name, named_profile, dry_run)
+
+
+def _map_accounts(action, accounts, max_workers, provider_name, named_profile, dry_run):
+    accounts = list(accounts)
+    if not accounts:
+        return
+
+    # fail here, the process pool would wait forever for a task that could not be sent to a worker
+    pickle.dumps(action, pickle.HIGHEST_PROTOCOL)
+
+    with futures.ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(accounts)))) as executor:
+        pending = {}
+        for profile_name, env_name in accounts:
+            future = executor.submit(_run_account, profile_name, env_name, action,
+                                     provider_name, named_profile, dry_run)
+            pending[future] = (profile_name, env_name)
+
+        for future in futures.as_completed(pending):
+            error = future.exception()
+            if error:
+                # the worker process itself failed
+                profile_name, env_name = pending[future]
+                yield AccountResult(profile_name, env_name, error=repr(error))
+            else:
+                yield future.result()
@@ -1,4 +1,4 @@
 __author__ = 'emg33'
 
 # define modules to import when from ... import * syntax is used
-__all__ = ["compute", "dns", "dynamodb", "provider", "storage"]
+__all__ = ["balancers", "catalog", "clients", "compute", "dns", "dynamodb", "errors", "inventory", "localcache", "metrics", "parallel", "provider", "ratelimit", "regions", "storage", "tagging", "waiters", "waves", "zones"]
@@ -0,0 +1,101 @@
+import threading
+import time
+
+__author__ = 'emg33'
+
+
+class BalancerIndex(object):
+    """
+    Cached classic ELB membership built from paginated describe_load_balancers calls,
+    with a reverse index from instance to the balancers it is registered with.
+    """
+
+    def __init__(self, elbclient, ttl=60):
+        """
+        :param elbclient: ElasticLoadBalancing.Client
+        :param ttl: int seconds before the index is considered stale, None never expires
+        """
+        self.elbclient = elbclient
+        self.ttl = ttl
+        self.refreshed_at = None
+
+        self._lock = threading.Lock()
+        self._members = {}
+        self._balancers = {}
+
+    def refresh(self):
+        """
+        :return: int number of balancers
+        """
+        members = {}
+        balancers = {}
+
+        # http://boto3.readthedocs.org/en/latest/reference/services/elb.html#ElasticLoadBalancing.Paginator.DescribeLoadBalancers
+        paginator = self.elbclient.get_paginator('describe_load_balancers')
+        for page in paginator.paginate():
+            for elb in page['LoadBalancerDescriptions']:
+                LoadBalancerName = elb['LoadBalancerName']
+                members[LoadBalancerName] = set(i['InstanceId'] for i in elb['Instances'])
+                for InstanceId in members[LoadBalancerName]:
+                    balancers.setdefault(InstanceId, set()).add(LoadBalancerName)
+
+        with self._lock:
+            self._members = members
+            self._balancers = balancers
+            self.refreshed_at = time.time()
+
+        return len(members)
+
+    def invalidate(self):
+        with self._lock:
+            self.refreshed_at = None
+
+    def is_stale(self):
+        if self.refreshed_at is None:
+            return True
+        return self.ttl is not None and time.time() - self.refreshed_at > self.ttl
+
+    def _ensure_fresh(self):
+        if self.is_stale():
+            self.refresh()
+
+    def members(self, LoadBalancerName):
+        """
+        :return: set[str] instance ids registered with the balancer
+        """
+        self._ensure_fresh()
+        with self._lock:
+            return set(self._members.get(LoadBalancerName, ()))
+
+    def balancers_of(self, InstanceIds):
+        """
+        :param InstanceIds: list[str]
+        :return: dict[str, set[str]] the given instances keyed by the balancers they are registered with
+        """
+        self._ensure_fresh()
+
+        attached = {}
+        with self._lock:
+            for InstanceId in InstanceIds:
+                for LoadBalancerName in self._balancers.get(InstanceId, ()):
+                    attached.setdefault(LoadBalancerName, set()).add(InstanceId)
+
+        return attached
+
+    def registered(self, LoadBalancerName, InstanceIds):
+        """
+        record a registration made through cucloud without a new describe
+        """
+        with self._lock:
+            self._members.setdefault(LoadBalancerName, set()).update(InstanceIds)
+            for InstanceId in InstanceIds:
+                self._balancers.setdefault(InstanceId, set()).add(LoadBalancerName)
+
+    def deregistered(self, LoadBalancerName, InstanceIds):
+        """
+        record a deregistration made through cucloud without a new describe
+        """
+        with self._lock:
+            self._members.get(LoadBalancerName, set()).difference_update(InstanceIds)
+            for InstanceId in InstanceIds:
+                self._balancers.get(InstanceId, set()).discard(LoadBalancerName)
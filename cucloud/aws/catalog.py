@@ -0,0 +1,203 @@
+import datetime
+import json
+import sqlite3
+import threading
+import time
+from cucloud.retention import to_epoch
+from dateutil.tz import tzutc
+
+__author__ = 'emg33'
+
+
+def _from_epoch(epoch):
+    return datetime.datetime.fromtimestamp(epoch, tzutc())
+
+
+class SnapshotCatalog(object):
+    """
+    Persistent local (SQLite) catalog of the snapshots owned by the account, keyed by snapshot id
+    with indexes on volume id, cucloud-snapshot tag and start time.
+
+    refresh() merges a paginated describe_snapshots sweep into the catalog and prunes snapshots that
+    were not seen anymore. Queries run locally, ensure_fresh() bounds how stale they may be.
+    """
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS snapshots (
+            snapshot_id TEXT PRIMARY KEY,
+            volume_id TEXT,
+            cucloud_tag TEXT,
+            start_time REAL,
+            state TEXT,
+            description TEXT,
+            tags TEXT,
+            sweep INTEGER
+        )''',
+        'CREATE INDEX IF NOT EXISTS snapshots_volume_id ON snapshots (volume_id)',
+        'CREATE INDEX IF NOT EXISTS snapshots_cucloud_tag ON snapshots (cucloud_tag, start_time)',
+        'CREATE INDEX IF NOT EXISTS snapshots_start_time ON snapshots (start_time)',
+        'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)',
+    ]
+
+    # volume ids per query, SQLite allows at most 999 bound parameters by default
+    MAX_VOLUME_IDS = 500
+
+    def __init__(self, ec2client, path, max_age=3600):
+        """
+        :param ec2client: EC2.Client
+        :param path: str SQLite database file
+        :param max_age: int seconds the catalog may be stale before ensure_fresh() refreshes it
+        """
+        self.ec2client = ec2client
+        self.path = path
+        self.max_age = max_age
+
+        self._lock = threading.RLock()
+        # shared by worker threads, access is serialized by _lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _meta(self, key, value=None):
+        if value is None:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else None
+
+        self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    @property
+    def refreshed_at(self):
+        """
+        :return: float epoch of the last complete refresh, None if never refreshed
+        """
+        with self._lock:
+            value = self._meta('refreshed_at')
+        return float(value) if value else None
+
+    def age(self):
+        """
+        :return: float seconds since the last complete refresh, None if never refreshed
+        """
+        refreshed_at = self.refreshed_at
+        if refreshed_at is None:
+            return None
+        return time.time() - refreshed_at
+
+    def ensure_fresh(self, max_age=None):
+        """
+        refresh if the catalog is older than max_age (default self.max_age) seconds
+
+        :return: bool whether a refresh was needed
+        """
+        if max_age is None:
+            max_age = self.max_age
+
+        age = self.age()
+        if age is not None and age <= max_age:
+            return False
+
+        self.refresh()
+        return True
+
+    def refresh(self):
+        """
+        merge all snapshots owned by the account into the catalog and prune those no longer seen
+
+        :return: dict with 'seen' and 'pruned' counts
+        """
+        with self._lock:
+            sweep = int(self._meta('sweep') or 0) + 1
+
+        seen = 0
+        paginator = self.ec2client.get_paginator('describe_snapshots')
+        for page in paginator.paginate(OwnerIds=['self']):
+            rows = []
+            for snapshot in page['Snapshots']:
+                tags = snapshot.get('Tags') or []
+                cucloud_tag = None
+                for tag in tags:
+                    if tag['Key'] == 'cucloud-snapshot':
+                        cucloud_tag = tag['Value'].lower()
+
+                rows.append((snapshot['SnapshotId'], snapshot.get('VolumeId'), cucloud_tag,
+                             to_epoch(snapshot['StartTime']), snapshot.get('State'),
+                             snapshot.get('Description'), json.dumps(tags), sweep))
+
+            with self._lock:
+                self._db.executemany('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                self._db.commit()
+            seen += len(rows)
+
+        # only prune after a complete sweep
+        with self._lock:
+            pruned = self._db.execute('DELETE FROM snapshots WHERE sweep != ?', (sweep,)).rowcount
+            self._meta('sweep', sweep)
+            self._meta('refreshed_at', time.time())
+            self._db.commit()
+
+        return {'seen': seen, 'pruned': pruned}
+
+    def forget(self, SnapshotIds):
+        """
+        remove snapshots deleted through cucloud without waiting for the next refresh
+        """
+        with self._lock:
+            self._db.executemany('DELETE FROM snapshots WHERE snapshot_id = ?', [(i,) for i in SnapshotIds])
+            self._db.commit()
+
+    def snapshots(self, VolumeIds=None, snapshot_tag=None, before=None, state='completed'):
+        """
+        :param VolumeIds: list[str] only these volumes
+        :param snapshot_tag: str only snapshots with this cucloud-snapshot tag
+        :param before: datetime only snapshots started at or before
+        :param state: str only snapshots in this state, None for any
+        :return: list[dict] shaped like describe_snapshots entries, oldest first
+        """
+        where = []
+        params = []
+        if snapshot_tag:
+            where.append('cucloud_tag = ?')
+            params.append(snapshot_tag)
+        if before is not None:
+            where.append('start_time <= ?')
+            params.append(to_epoch(before))
+        if state:
+            where.append('state = ?')
+            params.append(state)
+
+        sql = 'SELECT snapshot_id, volume_id, start_time, state, description, tags FROM snapshots'
+
+        if VolumeIds is None:
+            queries = [(where, params)]
+        else:
+            # a volume in two chunks would return its snapshots twice
+            VolumeIds = sorted(set(VolumeIds))
+            queries = []
+            for i in range(0, len(VolumeIds), self.MAX_VOLUME_IDS):
+                chunk = VolumeIds[i:i + self.MAX_VOLUME_IDS]
+                queries.append((where + ['volume_id IN (' + ', '.join('?' * len(chunk)) + ')'], params + chunk))
+
+        rows = []
+        with self._lock:
+            for query_where, query_params in queries:
+                query = sql
+                if query_where:
+                    query += ' WHERE ' + ' AND '.join(query_where)
+                rows.extend(self._db.execute(query + ' ORDER BY start_time', query_params).fetchall())
+
+        if len(queries) > 1:
+            # each chunk is ordered on its own
+            rows.sort(key=lambda row: row[2])
+
+        return [{'SnapshotId': row[0],
+                 'VolumeId': row[1],
+                 'StartTime': _from_epoch(row[2]),
+                 'State': row[3],
+                 'Description': row[4],
+                 'Tags': json.loads(row[5])} for row in rows]
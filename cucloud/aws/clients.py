@@ -0,0 +1,108 @@
+import boto3
+import boto3.session
+import threading
+from botocore.config import Config
+from cucloud.aws import ratelimit
+from cucloud.aws.metrics import ApiStats
+
+__author__ = 'emg33'
+
+
+class ClientRegistry(object):
+    """
+    Provider owned cache of boto3 sessions, clients and resources keyed by (service, region, profile),
+    so Compute, Storage and Dns share connection pools instead of rebuilding them on every call.
+
+    Clients are thread safe and shared by all threads. Resources are not, so they are cached per thread.
+    Every client, including those behind resources, reports its calls to stats and takes its
+    requests from rate_limiter, throttled requests are retried up to max_attempts times.
+    """
+
+    def __init__(self, profile_name=None, region_name=None, max_pool_connections=10, stats=None,
+                 rate_limiter=None, max_attempts=10):
+        """
+        :param profile_name: str AWS named profile, None for the default credential chain
+        :param region_name: str default region, None for the configured default
+        :param max_pool_connections: int HTTP connections per client, should cover the configured concurrency
+        :param stats: cucloud.aws.metrics.ApiStats shared metrics, a private collector if not set
+        :param rate_limiter: cucloud.aws.ratelimit.RateLimiter, the process wide limiter if not set
+        :param max_attempts: int retries botocore makes with jittered exponential backoff
+        """
+        self.profile_name = profile_name
+        self.region_name = region_name
+        self.max_pool_connections = max_pool_connections
+
+        if stats is None:
+            stats = ApiStats()
+        self.stats = stats
+
+        if rate_limiter is None:
+            rate_limiter = ratelimit.shared_limiter
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._sessions = {}
+        self._clients = {}
+
+    def _key(self, service_name, region_name, profile_name):
+        if region_name is None:
+            region_name = self.region_name
+        if profile_name is None:
+            profile_name = self.profile_name
+        return service_name, region_name, profile_name
+
+    def _config(self):
+        return Config(max_pool_connections=self.max_pool_connections, retries={'max_attempts': self.max_attempts})
+
+    def _instrument(self, client):
+        self.rate_limiter.instrument(client)
+        return self.stats.instrument(client)
+
+    def session(self, region_name=None, profile_name=None):
+        """
+        :return: boto3.session.Session
+        """
+        _, region_name, profile_name = self._key(None, region_name, profile_name)
+
+        with self._lock:
+            key = (region_name, profile_name)
+            if key not in self._sessions:
+                self._sessions[key] = boto3.session.Session(profile_name=profile_name, region_name=region_name)
+            return self._sessions[key]
+
+    def client(self, service_name, region_name=None, profile_name=None):
+        """
+        shared, thread safe client
+
+        :return: botocore.client.BaseClient
+        """
+        key = self._key(service_name, region_name, profile_name)
+
+        with self._lock:
+            if key not in self._clients:
+                # session methods are not thread safe, hence created under the lock
+                session = self.session(region_name=key[1], profile_name=key[2])
+                self._clients[key] = self._instrument(session.client(service_name, config=self._config()))
+            return self._clients[key]
+
+    def resource(self, service_name, region_name=None, profile_name=None):
+        """
+        resource owned by the calling thread
+
+        :return: boto3.resources.base.ServiceResource
+        """
+        key = self._key(service_name, region_name, profile_name)
+
+        resources = getattr(self._local, 'resources', None)
+        if resources is None:
+            resources = self._local.resources = {}
+
+        if key not in resources:
+            with self._lock:
+                session = self.session(region_name=key[1], profile_name=key[2])
+                resources[key] = session.resource(service_name, config=self._config())
+                self._instrument(resources[key].meta.client)
+
+        return resources[key]
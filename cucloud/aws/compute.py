@@ -2,6 +2,16 @@ import boto3
 import boto3.utils
 import abc
 import time
+from botocore.exceptions import ClientError
+from concurrent import futures
+from cucloud.aws import parallel
+from cucloud.aws.balancers import BalancerIndex
+from cucloud.aws.clients import ClientRegistry
+from cucloud.aws.errors import is_dry_run
+from cucloud.aws.inventory import Ec2Inventory
+from cucloud.aws.tagging import TagWriter
+from cucloud.aws.waiters import InstanceStateWaiter
+from cucloud.aws.waves import WaveScheduler
 from cucloud.compute import ComputeBase
 
 __author__ = 'emg33'
@@ -10,21 +20,111 @@ __author__ = 'emg33'
 class Compute(ComputeBase):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self):
+    def __init__(self, clients=None, region_name=None):
+        """
+        :param clients: cucloud.aws.clients.ClientRegistry shared clients, a private registry if not set
+        :param region_name: str region to act on, the registry default if not set
+        """
         super(Compute, self).__init__()
 
+        if clients is None:
+            clients = ClientRegistry()
+        self.clients = clients
+
         # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#client
-        self.ec2client = boto3.client('ec2')
+        self.ec2client = clients.client('ec2', region_name=region_name)
         # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#service-resource
-        self.ec2resource = boto3.resource('ec2')
+        self.ec2resource = clients.resource('ec2', region_name=region_name)
         # http://boto3.readthedocs.org/en/latest/reference/services/elb.html#client
-        self.elbclient = boto3.client('elb')
+        self.elbclient = clients.client('elb', region_name=region_name)
+        self.region_name = self.ec2client.meta.region_name
+
+        # cached instance/balancer membership for lookups, refreshed at most once a minute, stops describe afresh
+        self.balancer_index = BalancerIndex(self.elbclient)
+        # balancers deregistered from in parallel
+        self.max_balancer_workers = 10
+
+        # optional in-memory inventory answering tag lookups, see use_inventory()
+        self.inventory = None
+        self._waiter = None
+        self._tagger = None
+
+    @property
+    def tagger(self):
+        """
+        coalescing tag writer shared by bulk tagging, created on first use
+
+        :return: cucloud.aws.tagging.TagWriter
+        """
+        if not self._tagger:
+            self._tagger = TagWriter(self.ec2client)
+        self._tagger.dry_run = self.dry_run
+        return self._tagger
+
+    def tag_instances(self, InstanceIds, Tags, flush=True):
+        """
+        tag many instances, batched with any other pending tag writes sharing the same tags
+
+        :param InstanceIds: list[str]
+        :param Tags: list[dict]
+        :param flush: bool write now, otherwise left to the tagger size/time thresholds
+        """
+        self.tagger.add(InstanceIds, Tags)
+        if flush:
+            self.tagger.flush()
+        self._instances_changed()
+
+    @property
+    def waiter(self):
+        """
+        shared wait-manager for the *_async methods, created on first use
+
+        :return: cucloud.aws.waiters.InstanceStateWaiter
+        """
+        if not self._waiter:
+            self._waiter = InstanceStateWaiter(self.ec2client)
+        return self._waiter
+
+    def _not_started_future(self, error, dry_run_message, callback=None):
+        """
+        future for a request that failed before anything could be waited on,
+        resolved with False for a dry run like the blocking methods return
+        """
+        future = futures.Future()
+        future.set_running_or_notify_cancel()
+        if callback:
+            future.add_done_callback(callback)
+
+        if is_dry_run(error):
+            print dry_run_message
+            future.set_result(False)
+        else:
+            future.set_exception(error)
+
+        return future
+
+    def use_inventory(self, ttl=60):
+        """
+        answer tag lookups from an in-memory inventory built by one paginated describe_instances
+        sweep, repeated once older than ttl seconds (None: only on inventory.refresh())
+
+        :param ttl: int
+        :return: cucloud.aws.inventory.Ec2Inventory
+        """
+        self.inventory = Ec2Inventory(self.ec2client, ttl=ttl)
+        return self.inventory
+
+    def _instances_changed(self):
+        if self.inventory:
+            self.inventory.invalidate()
 
     def instances_tagged(self, tag_key, tag_values):
         """
         gets instances
         :rtype: list[EC2.Instance]
         """
+        if self.inventory:
+            return [self.ec2resource.Instance(i) for i in self.inventory.instance_ids_tagged(tag_key, tag_values)]
 
         # find instances by tag
         instances = self.ec2resource.instances.filter(Filters=[{'Name': 'tag:' + tag_key, 'Values': tag_values}])
@@ -37,6 +137,9 @@ class Compute(ComputeBase):
         :param tag_values: list[str]
         :return: list[str]
         """
+        if self.inventory:
+            return self.inventory.instance_ids_tagged(tag_key, tag_values)
+
         instances = self.instances_tagged(tag_key, tag_values)
 
         instance_ids = [i.id for i in instances]
@@ -44,14 +147,59 @@ class Compute(ComputeBase):
         return instance_ids
 
 
+    def _tagged_pages(self, tag_key, tag_values):
+        """
+        single tag filtered, paginated describe_instances
+
+        :return: generator of dict pages
+        """
+        if not tag_values:
+            return
+
+        # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Paginator.DescribeInstances
+        paginator = self.ec2client.get_paginator('describe_instances')
+        pages = paginator.paginate(Filters=[{'Name': 'tag:' + tag_key, 'Values': tag_values}])
+
+        for page in pages:
+            yield page
+
+    def iter_instances_tagged(self, tag_key, tag_values):
+        """
+        raw instance dicts streamed page by page, memory stays constant regardless of the number of instances
+
+        :param tag_key: str
+        :param tag_values: list[str]
+        :return: generator of dict
+        """
+        if self.inventory:
+            for instance in self.inventory.instances_tagged(tag_key, tag_values):
+                yield instance
+            return
+
+        for page in self._tagged_pages(tag_key, tag_values):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    yield instance
+
     def descr_instances_tagged(self, tag_key, tag_values):
-        instance_ids = self.instance_ids_tagged(tag_key, tag_values)
+        """
+        describe_instances style response for the tagged instances, built from one tag filtered
+        (paginated) describe, no match returns no reservations. After use_inventory() it is answered
+        from the inventory, the instances then share a single reservation
 
-        response = self.ec2client.describe_instances(
-            InstanceIds=instance_ids
-        )
+        :param tag_key: str
+        :param tag_values: list[str]
+        :return: dict
+        """
+        if self.inventory:
+            instances = list(self.iter_instances_tagged(tag_key, tag_values))
+            return {'Reservations': [{'Instances': instances}] if instances else []}
+
+        reservations = []
+        for page in self._tagged_pages(tag_key, tag_values):
+            reservations.extend(page['Reservations'])
 
-        return response
+        return {'Reservations': reservations}
 
     def start_instances_tagged(self, tag_key, tag_values):
         """
@@ -73,8 +221,7 @@ class Compute(ComputeBase):
         :param tag_values: list[str]
         :return:
         """
-        instances = self.instances_tagged(tag_key, tag_values)
-        instance_ids = [i.id for i in instances]
+        instance_ids = self.instance_ids_tagged(tag_key, tag_values)
 
         return self.stop_instances(instance_ids)
 
@@ -86,8 +233,7 @@ class Compute(ComputeBase):
         :param tag_values: list[str]
         :return:
         """
-        instances = self.instances_tagged(tag_key, tag_values)
-        instance_ids = [i.id for i in instances]
+        instance_ids = self.instance_ids_tagged(tag_key, tag_values)
 
         return self.reboot_instances(instance_ids)
 
@@ -106,6 +252,7 @@ class Compute(ComputeBase):
                 InstanceIds=InstanceIds,
                 DryRun=self.dry_run
             )
+            self._instances_changed()
 
             print "Waiting until instance(s) are running."
             waiter = self.ec2client.get_waiter('instance_running')
@@ -113,11 +260,97 @@ class Compute(ComputeBase):
             print "Wait complete. Instance(s) started."
 
             return response
-        except Exception:
+        except ClientError as e:
+            if not is_dry_run(e):
+                raise
             print "DRY-RUN started instance(s)."
 
         return False
 
+    def start_instances_async(self, InstanceIds, callback=None):
+        """
+        start instances without blocking, many of these can be waited on at once
+
+        :param InstanceIds: list[str]
+        :param callback: callable called with the future once the instances are running
+        :return: concurrent.futures.Future resolved with the instance ids once running
+        """
+        print "Issuing start instance(s) for "
+        print InstanceIds
+        try:
+            self.ec2client.start_instances(
+                InstanceIds=InstanceIds,
+                DryRun=self.dry_run
+            )
+            self._instances_changed()
+        except Exception as e:
+            return self._not_started_future(e, "DRY-RUN started instance(s).", callback)
+
+        return self.waiter.watch(InstanceIds, 'running', callback=callback)
+
+    def stop_instances_async(self, InstanceIds, callback=None):
+        """
+        stop instances without blocking, deregisters them from load balancers first
+
+        :param InstanceIds: list[str]
+        :param callback: callable called with the future once the instances are stopped
+        :return: concurrent.futures.Future resolved with the instance ids once stopped
+        """
+        print "Issuing stop instance(s) for "
+        print InstanceIds
+        try:
+            self.deregister_instances_from_all_balancers(InstanceIds)
+
+            self.ec2client.stop_instances(
+                InstanceIds=InstanceIds,
+                DryRun=self.dry_run
+            )
+            self._instances_changed()
+        except Exception as e:
+            return self._not_started_future(e, "DRY-RUN stopped instance(s).", callback)
+
+        return self.waiter.watch(InstanceIds, 'stopped', callback=callback)
+
+    def reboot_instances_async(self, InstanceIds, callback=None):
+        """
+        reboot instances without blocking
+
+        The instance state stays running through a reboot, so the future resolves once EC2 accepted
+        the reboot and the instances report running, not once they are back in service.
+
+        :param InstanceIds: list[str]
+        :param callback: callable called with the future once the instances report running
+        :return: concurrent.futures.Future resolved with the instance ids
+        """
+        try:
+            self.ec2client.reboot_instances(
+                InstanceIds=InstanceIds,
+                DryRun=self.dry_run
+            )
+        except Exception as e:
+            return self._not_started_future(e, "DRY-RUN reboot instances for " + ", ".join(InstanceIds), callback)
+
+        return self.waiter.watch(InstanceIds, 'running', callback=callback)
+
+    def rolling_instances_tagged(self, action, tag_key, tag_values, wave_size=10, max_in_flight=2, health_check=None):
+        """
+        start, stop or reboot tagged instances in rolling waves instead of one all-or-nothing call
+
+        :param action: str start, stop or reboot
+        :param tag_key: str
+        :param tag_values: list[str]
+        :param wave_size: int instances per wave
+        :param max_in_flight: int waves waited on at once
+        :param health_check: callable taking a wave's instance ids, returning False to stop further waves,
+                             required for reboot, it decides when a rebooted wave is back in service
+        :return: dict see cucloud.aws.waves.WaveScheduler.run
+        """
+        instance_ids = self.instance_ids_tagged(tag_key, tag_values)
+
+        scheduler = WaveScheduler(self, wave_size=wave_size, max_in_flight=max_in_flight, health_check=health_check)
+
+        return scheduler.run(action, instance_ids)
+
     def attach_instance_to_balancer(self, InstanceId, LoadBalancerName):
         print "Registering " + InstanceId + " with elb: " + LoadBalancerName
         if not self.dry_run:
@@ -125,50 +358,201 @@ class Compute(ComputeBase):
                 LoadBalancerName=LoadBalancerName,
                 Instances=[{'InstanceId': InstanceId}]
             )
+            self.balancer_index.registered(LoadBalancerName, [InstanceId])
             return response
         return False
 
     def start_instance_and_attach_to_balancers(self, InstanceId, LoadBalancerNames):
-        # start instances
-        startresponse = self.start_instances([InstanceId])
+        """
+        :return: bool True once running and registered, False if not started
+        """
+        return self.start_instances_and_attach_to_balancers({InstanceId: LoadBalancerNames})[InstanceId]
+
+    def start_instances_and_attach_to_balancers(self, InstanceBalancers):
+        """
+        start many instances at once and register them with their balancers as soon as they are running,
+        instances found running by the same poll are registered with one call per balancer
+
+        :param InstanceBalancers: dict[str, list[str]] LoadBalancerNames keyed by InstanceId
+        :return: dict[str, bool] True once running and registered keyed by InstanceId, False if not started
+        """
+        InstanceIds = sorted(InstanceBalancers)
+
+        started = self.start_instances_async(InstanceIds)
+        if started.done() and (started.exception() or started.result() is False):
+            return dict((InstanceId, False) for InstanceId in InstanceIds)
+
+        # one watch per instance so each is attached without waiting for the slowest
+        pending = dict((self.waiter.watch([InstanceId], 'running'), InstanceId) for InstanceId in InstanceIds)
+
+        responses = {}
+        while pending:
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+
+            BalancerInstances = {}
+            running = []
+            for future in done:
+                InstanceId = pending.pop(future)
+                if future.exception():
+                    print "Instance " + InstanceId + " did not start: " + str(future.exception())
+                    responses[InstanceId] = False
+                    continue
+
+                running.append(InstanceId)
+                for LoadBalancerName in InstanceBalancers[InstanceId]:
+                    BalancerInstances.setdefault(LoadBalancerName, []).append(InstanceId)
+
+            if BalancerInstances:
+                self.set_balancer_membership(BalancerInstances)
+            for InstanceId in running:
+                responses[InstanceId] = True
 
-        response = None
-        # register with load balancer
-        for LoadBalancerName in LoadBalancerNames:
-            response = self.attach_instance_to_balancer(InstanceId, LoadBalancerName)
+        return responses
 
-        # return the load response of registering
-        return response
+    def describe_balancer_members(self, LoadBalancerNames):
+        """
+        current membership of the given balancers, one describe_load_balancers per 20 names
 
-    def deregister_instances_from_all_balancers(self, InstanceIds):
-        # de-register any instances if they're attached to balancers
-        elbs = self.elbclient.describe_load_balancers()
+        :param LoadBalancerNames: list[str]
+        :return: dict[str, set[str]] instance ids keyed by LoadBalancerName
+        """
+        LoadBalancerNames = list(LoadBalancerNames)
+        members = {}
 
-        for elb in elbs['LoadBalancerDescriptions']:
-            # get the list intersection of InstanceIds and elb['Instances']
-            elbiids = [i['InstanceId'] for i in elb['Instances']]
+        paginator = self.elbclient.get_paginator('describe_load_balancers')
+        for i in range(0, len(LoadBalancerNames), 20):
+            for page in paginator.paginate(LoadBalancerNames=LoadBalancerNames[i:i + 20]):
+                for elb in page['LoadBalancerDescriptions']:
+                    members[elb['LoadBalancerName']] = set(i['InstanceId'] for i in elb['Instances'])
 
-            instance_ids_attached_to_balancer = list(set(InstanceIds).intersection(elbiids))
-            if instance_ids_attached_to_balancer:
-                print "Deregistering instances from elb '" + elb['LoadBalancerName'] + "'"
-                print instance_ids_attached_to_balancer
+        return members
 
-                elb_instance_id_dict = []
-                for i in instance_ids_attached_to_balancer:
-                    elb_instance_id_dict.append({'InstanceId': i})
+    def set_balancer_membership(self, BalancerInstances, remove_others=False):
+        """
+        bring balancers to the desired membership with at most one register and one deregister call
+        per balancer, diffed against a single describe, balancers are handled in parallel
+
+        :param BalancerInstances: dict[str, list[str]] desired InstanceIds keyed by LoadBalancerName
+        :param remove_others: bool also deregister (and drain) instances that are not listed
+        :return: dict[str, dict] 'registered' and 'deregistered' instance ids keyed by LoadBalancerName
+        """
+        LoadBalancerNames = sorted(BalancerInstances)
+        current = self.describe_balancer_members(LoadBalancerNames)
 
+        def apply_membership(LoadBalancerName):
+            desired = set(BalancerInstances[LoadBalancerName])
+            members = current.get(LoadBalancerName, set())
+
+            changes = {'registered': sorted(desired - members), 'deregistered': []}
+            if remove_others:
+                changes['deregistered'] = sorted(members - desired)
+
+            if changes['registered']:
+                print "Registering " + ", ".join(changes['registered']) + " with elb: " + LoadBalancerName
                 # dry-run is not supported by ELB client!
                 if not self.dry_run:
-                    self.elbclient.deregister_instances_from_load_balancer(
-                        LoadBalancerName=elb['LoadBalancerName'],
-                        Instances=elb_instance_id_dict
+                    self.elbclient.register_instances_with_load_balancer(
+                        LoadBalancerName=LoadBalancerName,
+                        Instances=[{'InstanceId': i} for i in changes['registered']]
                     )
+                    self.balancer_index.registered(LoadBalancerName, changes['registered'])
+
+            if changes['deregistered']:
+                self._deregister_from_balancer(LoadBalancerName, changes['deregistered'])
+
+            return changes
+
+        results = parallel.map_ordered(apply_membership, LoadBalancerNames, self.max_balancer_workers)
+
+        membership = {}
+        for LoadBalancerName, (changes, error) in zip(LoadBalancerNames, results):
+            if error:
+                self.balancer_index.invalidate()
+                raise error
+            membership[LoadBalancerName] = changes
+
+        return membership
+
+    def attach_instances_to_balancers(self, InstanceIds, LoadBalancerNames):
+        """
+        register a fleet of instances with each balancer using one call per balancer
+
+        :return: dict[str, dict] see set_balancer_membership
+        """
+        return self.set_balancer_membership(dict((LoadBalancerName, InstanceIds) for LoadBalancerName in LoadBalancerNames))
+
+    def deregister_instances_from_all_balancers(self, InstanceIds, fresh=True):
+        """
+        de-register any instances if they're attached to balancers, balancers are handled in parallel
+        and each is polled until its instances are drained
 
-                    # FIXME: no waiters available, but we could verify manually using describe_load_balancers again?
-                    time.sleep(10)
+        :param InstanceIds: list[str]
+        :param fresh: bool describe the balancers first, a cached index may miss a registration made
+                      elsewhere and the instance would be stopped while still in service
+        :return: bool
+        """
+        if fresh:
+            self.balancer_index.refresh()
+        attached = self.balancer_index.balancers_of(InstanceIds)
+        if not attached:
+            return True
+
+        LoadBalancerNames = sorted(attached)
+        results = parallel.map_ordered(
+            lambda LoadBalancerName: self._deregister_from_balancer(LoadBalancerName, sorted(attached[LoadBalancerName])),
+            LoadBalancerNames,
+            self.max_balancer_workers
+        )
+
+        for LoadBalancerName, (_, error) in zip(LoadBalancerNames, results):
+            if error:
+                # membership is unknown now
+                self.balancer_index.invalidate()
+                raise error
+
+        return True
+
+    def _deregister_from_balancer(self, LoadBalancerName, InstanceIds):
+        print "Deregistering instances from elb '" + LoadBalancerName + "'"
+        print InstanceIds
+
+        # dry-run is not supported by ELB client!
+        if self.dry_run:
+            return False
+
+        self.elbclient.deregister_instances_from_load_balancer(
+            LoadBalancerName=LoadBalancerName,
+            Instances=[{'InstanceId': i} for i in InstanceIds]
+        )
+
+        self.wait_for_deregistration(LoadBalancerName, InstanceIds)
+        self.balancer_index.deregistered(LoadBalancerName, InstanceIds)
 
         return True
 
+    def wait_for_deregistration(self, LoadBalancerName, InstanceIds, timeout=600, min_interval=1, max_interval=15):
+        """
+        no waiters available, poll describe_instance_health with backoff until the balancer
+        no longer lists the instances, i.e. connection draining has finished
+
+        :return: bool
+        """
+        InstanceIds = set(InstanceIds)
+        deadline = time.time() + timeout
+        interval = min_interval
+
+        while True:
+            response = self.elbclient.describe_instance_health(LoadBalancerName=LoadBalancerName)
+            remaining = InstanceIds.intersection(s['InstanceId'] for s in response['InstanceStates'])
+            if not remaining:
+                return True
+
+            if time.time() + interval > deadline:
+                raise Exception('Timed out waiting for elb "' + LoadBalancerName + '" to drain ' + ', '.join(sorted(remaining)))
+
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+
     def stop_instances(self, InstanceIds):
         """
         stop instances, initiates a waiter until the instances have stopped
@@ -186,6 +570,7 @@ class Compute(ComputeBase):
                 InstanceIds=InstanceIds,
                 DryRun=self.dry_run
             )
+            self._instances_changed()
 
             print "Waiting until stopped"
             waiter = self.ec2client.get_waiter('instance_stopped')
@@ -193,7 +578,9 @@ class Compute(ComputeBase):
             print "Waiter complete. Instances have been stopped."
 
             return len(InstanceIds)
-        except Exception:
+        except ClientError as e:
+            if not is_dry_run(e):
+                raise
             print "DRY-RUN stopped instance(s)."
 
         return False
@@ -206,7 +593,9 @@ class Compute(ComputeBase):
             )
 
             return response
-        except Exception:
+        except ClientError as e:
+            if not is_dry_run(e):
+                raise
             print "DRY-RUN reboot instances for "
             print InstanceIds
 
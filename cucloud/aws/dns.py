@@ -1,6 +1,8 @@
 import boto3
 import boto3.utils
 import abc
+from cucloud.aws.clients import ClientRegistry
+from cucloud.aws.zones import ZoneIndex
 from cucloud.dns import DnsBase
 
 __author__ = 'emg33'
@@ -9,20 +11,49 @@ __author__ = 'emg33'
 class Dns(DnsBase):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self):
+    def __init__(self, clients=None):
+        """
+        :param clients: cucloud.aws.clients.ClientRegistry shared clients, a private registry if not set
+        """
         super(Dns, self).__init__()
-        self.r53client = boto3.client('route53')
+
+        if clients is None:
+            clients = ClientRegistry()
+        self.clients = clients
+
+        self.r53client = clients.client('route53')
+        self._zone_index = None
+
+    @property
+    def zone_index(self):
+        """
+        index of every hosted zone's record sets, loaded on first use
+
+        :return: cucloud.aws.zones.ZoneIndex
+        """
+        if not self._zone_index:
+            self._zone_index = ZoneIndex(self.r53client)
+        return self._zone_index
 
     def hosted_domains(self):
-        hosted_zones = self.r53client.list_hosted_zones()['HostedZones']
+        hosted_zones = []
+        # http://boto3.readthedocs.org/en/latest/reference/services/route53.html#Route53.Paginator.ListHostedZones
+        paginator = self.r53client.get_paginator('list_hosted_zones')
+        for page in paginator.paginate():
+            hosted_zones.extend(page['HostedZones'])
 
         return hosted_zones
 
+    def records_pointing_to(self, target, record_type=None):
+        """
+        :param target: str record value or alias DNS name, e.g. an ELB DNSName
+        :return: list[dict] record sets of all hosted zones pointing at target
+        """
+        return self.zone_index.records_pointing_to(target, record_type=record_type)
+
     def print_zone_list(self):
-        hosted_zones = self.r53client.list_hosted_zones()['HostedZones']
-        for hosted_zone in hosted_zones:
+        for hosted_zone in self.zone_index.zones():
             #print hosted_zone['Name'], hosted_zone['Id']
-            record_sets = client.list_resource_record_sets(HostedZoneId=hosted_zone['Id'])['ResourceRecordSets']
-            for record_set in record_sets:
+            for record_set in self.zone_index.records(zone_id=hosted_zone['Id']):
                 print record_set
                 #print record_set['Name']
@@ -0,0 +1,41 @@
+from botocore.exceptions import ClientError
+
+__author__ = 'emg33'
+
+# error codes AWS services use to signal request throttling
+THROTTLE_CODES = frozenset(['Throttling',
+                            'ThrottlingException',
+                            'ThrottledException',
+                            'RequestThrottledException',
+                            'RequestLimitExceeded',
+                            'TooManyRequestsException',
+                            'ProvisionedThroughputExceededException',
+                            'RequestThrottled',
+                            'SlowDown',
+                            'PriorRequestNotComplete'])
+
+
+def error_code(error):
+    """
+    :param error: Exception
+    :return: str AWS error code of a ClientError, None for any other exception
+    """
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+def is_dry_run(error):
+    """
+    did a DryRun=True request fail only because it would have succeeded
+    """
+    return error_code(error) == 'DryRunOperation'
+
+
+def is_throttle(error):
+    """
+    :param error: Exception or str error code
+    """
+    if isinstance(error, Exception):
+        error = error_code(error)
+    return error in THROTTLE_CODES
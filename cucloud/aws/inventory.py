@@ -0,0 +1,126 @@
+import threading
+import time
+
+__author__ = 'emg33'
+
+
+class Ec2Inventory(object):
+    """
+    In-memory index of EC2 instances built from one paginated describe_instances sweep,
+    with secondary indexes by tag key/value, instance state, VPC and instance id.
+
+    The sweep is repeated once the inventory is older than ttl seconds (ttl None only refreshes
+    on an explicit refresh() / invalidate()), in between lookups don't call the API.
+    """
+
+    def __init__(self, ec2client, ttl=60):
+        """
+        :param ec2client: EC2.Client
+        :param ttl: int seconds before the inventory is considered stale, None never expires
+        """
+        self.ec2client = ec2client
+        self.ttl = ttl
+        self.refreshed_at = None
+
+        self._lock = threading.Lock()
+        self._by_id = {}
+        self._by_tag = {}
+        self._by_state = {}
+        self._by_vpc = {}
+
+    def refresh(self):
+        """
+        rebuild the inventory with one paginated describe_instances sweep
+
+        :return: int number of instances
+        """
+        by_id = {}
+        by_tag = {}
+        by_state = {}
+        by_vpc = {}
+
+        # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Paginator.DescribeInstances
+        paginator = self.ec2client.get_paginator('describe_instances')
+        for page in paginator.paginate():
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    InstanceId = instance['InstanceId']
+                    by_id[InstanceId] = instance
+
+                    for tag in instance.get('Tags') or []:
+                        by_tag.setdefault((tag['Key'], tag['Value']), set()).add(InstanceId)
+                    by_state.setdefault(instance['State']['Name'], set()).add(InstanceId)
+                    if instance.get('VpcId'):
+                        by_vpc.setdefault(instance['VpcId'], set()).add(InstanceId)
+
+        with self._lock:
+            self._by_id = by_id
+            self._by_tag = by_tag
+            self._by_state = by_state
+            self._by_vpc = by_vpc
+            self.refreshed_at = time.time()
+
+        return len(by_id)
+
+    def invalidate(self):
+        """
+        force a refresh on next lookup, e.g. after changing instance state
+        """
+        with self._lock:
+            self.refreshed_at = None
+
+    def is_stale(self):
+        if self.refreshed_at is None:
+            return True
+        return self.ttl is not None and time.time() - self.refreshed_at > self.ttl
+
+    def _ensure_fresh(self):
+        if self.is_stale():
+            self.refresh()
+
+    def instance(self, InstanceId):
+        """
+        :return: dict as returned by describe_instances, None if unknown
+        """
+        self._ensure_fresh()
+        return self._by_id.get(InstanceId)
+
+    def instance_ids_tagged(self, tag_key, tag_values):
+        """
+        :param tag_key: str
+        :param tag_values: list[str]
+        :return: list[str]
+        """
+        self._ensure_fresh()
+
+        instance_ids = set()
+        for tag_value in tag_values:
+            instance_ids.update(self._by_tag.get((tag_key, tag_value), ()))
+
+        return sorted(instance_ids)
+
+    def instances_tagged(self, tag_key, tag_values):
+        """
+        :return: list[dict]
+        """
+        return [self._by_id[i] for i in self.instance_ids_tagged(tag_key, tag_values)]
+
+    def instance_ids_in_state(self, states):
+        """
+        :param states: list[str] e.g. ['running', 'stopped']
+        :return: list[str]
+        """
+        self._ensure_fresh()
+
+        instance_ids = set()
+        for state in states:
+            instance_ids.update(self._by_state.get(state, ()))
+
+        return sorted(instance_ids)
+
+    def instance_ids_in_vpc(self, VpcId):
+        """
+        :return: list[str]
+        """
+        self._ensure_fresh()
+        return sorted(self._by_vpc.get(VpcId, ()))
@@ -0,0 +1,130 @@
+import decimal
+import errno
+import json
+import os
+import re
+import time
+
+__author__ = 'emg33'
+
+# tables confirmed to exist during this process, see table_known()
+_known_tables = set()
+
+
+def cache_dir():
+    """
+    local cache directory, E=CUCLOUD_CACHE_DIR or ~/.cucloud
+
+    :return: str
+    """
+    path = os.environ.get('CUCLOUD_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cucloud')
+
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    return path
+
+
+def cache_path(*parts):
+    """
+    file name in the cache directory built from parts, unsafe characters replaced
+
+    :return: str
+    """
+    name = '-'.join(re.sub(r'[^A-Za-z0-9_.-]', '_', str(part)) for part in parts)
+    return os.path.join(cache_dir(), name)
+
+
+def table_known(table_name, profile_name, region_name):
+    """
+    has table_name already been confirmed to exist for this profile (account) and region,
+    either during this process or by an earlier one (on-disk marker)
+
+    :return: bool
+    """
+    key = (table_name, profile_name, region_name)
+    if key in _known_tables:
+        return True
+
+    try:
+        if os.path.exists(cache_path('table', table_name, profile_name, region_name)):
+            _known_tables.add(key)
+            return True
+    except (IOError, OSError):
+        pass
+
+    return False
+
+
+def remember_table(table_name, profile_name, region_name):
+    _known_tables.add((table_name, profile_name, region_name))
+
+    try:
+        open(cache_path('table', table_name, profile_name, region_name), 'w').close()
+    except (IOError, OSError):
+        # the marker is only an optimization
+        pass
+
+
+def forget_table(table_name, profile_name, region_name):
+    _known_tables.discard((table_name, profile_name, region_name))
+
+    try:
+        os.remove(cache_path('table', table_name, profile_name, region_name))
+    except (IOError, OSError):
+        pass
+
+
+def _decimal_default(obj):
+    if isinstance(obj, decimal.Decimal):
+        if obj == obj.to_integral_value():
+            return int(obj)
+        return float(obj)
+    raise TypeError
+
+
+def load_config(profile_name, env_name, region_name):
+    """
+    locally cached profile/env config, numbers come back as Decimal like they do from DynamoDB
+
+    :return: dict with revision, config and age (seconds since written or confirmed), None if not cached
+    """
+    path = cache_path('config', profile_name, env_name, region_name)
+
+    try:
+        with open(path) as f:
+            cached = json.load(f, parse_float=decimal.Decimal, parse_int=decimal.Decimal)
+        cached['age'] = time.time() - os.path.getmtime(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if not isinstance(cached, dict) or 'config' not in cached:
+        return None
+
+    return cached
+
+
+def save_config(profile_name, env_name, region_name, revision, config):
+    path = cache_path('config', profile_name, env_name, region_name)
+
+    try:
+        # write then rename so concurrent readers never see a partial file
+        tmp_path = path + '.' + str(os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'revision': revision, 'config': config}, f, default=_decimal_default)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def touch_config(profile_name, env_name, region_name):
+    """
+    mark the cached config as confirmed fresh now
+    """
+    try:
+        os.utime(cache_path('config', profile_name, env_name, region_name), None)
+    except (IOError, OSError):
+        pass
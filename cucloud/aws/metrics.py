@@ -0,0 +1,142 @@
+import json
+import sys
+import threading
+import time
+from cucloud.aws.errors import is_throttle
+
+__author__ = 'emg33'
+
+
+class ApiStats(object):
+    """
+    Per service/operation API call metrics collected through botocore event hooks:
+    call counts, errors by code, retries, throttled attempts and a latency histogram.
+
+    instrument() registers the hooks on a client, ClientRegistry does this for every client it creates.
+    """
+
+    # upper bounds (seconds) of the latency histogram buckets, slower calls land in the last '+Inf' bucket
+    BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+        self.started = time.time()
+
+    def _operation(self, service_name, operation_name):
+        # caller holds the lock
+        key = (service_name, operation_name)
+        if key not in self._operations:
+            self._operations[key] = {'calls': 0,
+                                     'errors': {},
+                                     'retries': 0,
+                                     'throttles': 0,
+                                     'seconds': 0.0,
+                                     'max_seconds': 0.0,
+                                     'histogram': [0] * (len(self.BUCKETS) + 1)}
+        return self._operations[key]
+
+    def instrument(self, client):
+        """
+        register the metric hooks on a client
+
+        :param client: botocore.client.BaseClient
+        :return: client
+        """
+        service_name = client.meta.service_model.service_name
+        events = client.meta.events
+
+        def before_call(model, context, **kwargs):
+            context['cucloud_started'] = time.time()
+
+        def after_call(http_response, parsed, model, context, **kwargs):
+            started = context.get('cucloud_started')
+            seconds = time.time() - started if started else 0.0
+            error_code = parsed.get('Error', {}).get('Code') if parsed else None
+            retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0) if parsed else 0
+            self.record(service_name, model.name, seconds, error_code=error_code, retries=retries)
+
+        def needs_retry(response, operation, **kwargs):
+            # every attempt passes here, including the ones retried away, only observe and return None
+            if response and response[1] and is_throttle(response[1].get('Error', {}).get('Code')):
+                with self._lock:
+                    self._operation(service_name, operation.name)['throttles'] += 1
+
+        events.register('before-call.*.*', before_call, unique_id='cucloud-stats-before-call')
+        events.register('after-call.*.*', after_call, unique_id='cucloud-stats-after-call')
+        events.register('needs-retry.*.*', needs_retry, unique_id='cucloud-stats-needs-retry')
+
+        return client
+
+    def record(self, service_name, operation_name, seconds, error_code=None, retries=0):
+        """
+        record one completed call
+        """
+        bucket = len(self.BUCKETS)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            operation = self._operation(service_name, operation_name)
+            operation['calls'] += 1
+            operation['retries'] += retries
+            operation['seconds'] += seconds
+            operation['max_seconds'] = max(operation['max_seconds'], seconds)
+            operation['histogram'][bucket] += 1
+            if error_code:
+                operation['errors'][error_code] = operation['errors'].get(error_code, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+            self.started = time.time()
+
+    def summary(self):
+        """
+        :return: dict JSON serializable snapshot of the collected metrics
+        """
+        buckets = [str(bound) for bound in self.BUCKETS] + ['+Inf']
+
+        with self._lock:
+            operations = []
+            for (service_name, operation_name), operation in sorted(self._operations.items()):
+                calls = operation['calls']
+                operations.append({'service': service_name,
+                                   'operation': operation_name,
+                                   'calls': calls,
+                                   'errors': dict(operation['errors']),
+                                   'retries': operation['retries'],
+                                   'throttles': operation['throttles'],
+                                   'seconds': operation['seconds'],
+                                   'avg_seconds': operation['seconds'] / calls if calls else 0.0,
+                                   'max_seconds': operation['max_seconds'],
+                                   'histogram': dict(zip(buckets, operation['histogram']))})
+
+        return {'elapsed': time.time() - self.started,
+                'calls': sum(operation['calls'] for operation in operations),
+                'throttles': sum(operation['throttles'] for operation in operations),
+                'operations': operations}
+
+    def print_summary(self, out=None):
+        """
+        human readable table of the collected metrics
+        """
+        if out is None:
+            out = sys.stdout
+
+        summary = self.summary()
+
+        out.write("Service\t\tOperation\t\t\tCalls\tErrors\tRetries\tThrottles\tAvg(s)\tMax(s)\n")
+        for operation in summary['operations']:
+            out.write("%s\t\t%-24s\t%d\t%d\t%d\t%d\t\t%.3f\t%.3f\n" % (
+                operation['service'], operation['operation'], operation['calls'],
+                sum(operation['errors'].values()), operation['retries'], operation['throttles'],
+                operation['avg_seconds'], operation['max_seconds']))
+        out.write("Total calls: %d, throttled attempts: %d, elapsed: %.1fs\n" % (
+            summary['calls'], summary['throttles'], summary['elapsed']))
+
+    def write_json(self, out):
+        json.dump(self.summary(), out, sort_keys=True, indent=4, separators=(',', ': '))
+        out.write("\n")
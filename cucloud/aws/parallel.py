@@ -0,0 +1,31 @@
+from concurrent import futures
+
+__author__ = 'emg33'
+
+
+def map_ordered(func, items, max_workers=1):
+    """
+    Calls func on each of items using a bounded thread pool. A failing item does not
+    abort the batch, its exception is returned in place of its result.
+
+    :param func: callable taking a single item
+    :param items: list
+    :param max_workers: int
+    :return: list[tuple] of (result, exception) in input order
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    with futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as executor:
+        pending = [executor.submit(func, item) for item in items]
+
+        results = []
+        for future in pending:
+            error = future.exception()
+            if error:
+                results.append((None, error))
+            else:
+                results.append((future.result(), None))
+
+    return results
@@ -4,9 +4,14 @@ import os
 import decimal
 import json
 import ast
+import time
+from botocore.exceptions import ClientError
 from cucloud.aws import compute
+from cucloud.aws.clients import ClientRegistry
 from cucloud.aws import dns
 from cucloud.aws import dynamodb
+from cucloud.aws import localcache
+from cucloud.aws import regions
 from cucloud.aws import storage
 from cucloud.provider import ProviderBase
 
@@ -19,28 +24,73 @@ class AwsProvider(ProviderBase):
         super(AwsProvider, self).__init__(profile_name, env_name, dry_run=dry_run)
 
         self._config = None
+        # service objects per region name, None for the default region
+        self._compute = {}
+        self._storage = {}
+        self._dns = None
         self.use_named_profiles = str(named_profile)
 
+        # revision of the loaded config item, maintained by save_profile, None if never stamped
+        self.config_revision = None
+
+        # seconds a locally cached config is trusted without asking DynamoDB, 0 always checks the revision
+        self.config_ttl = 0
+        if os.environ.has_key('CUCLOUD_CONFIG_TTL'):
+            self.config_ttl = int(os.environ.get('CUCLOUD_CONFIG_TTL'))
+
+        # number of worker threads bulk operations may use, also sizes the HTTP connection pools
+        self.max_workers = 1
+        if os.environ.has_key('CUCLOUD_MAX_WORKERS'):
+            self.max_workers = int(os.environ.get('CUCLOUD_MAX_WORKERS'))
+
         if os.environ.has_key('CUCLOUD_AWS_USE_NAMED_PROFILE'):
             self.use_named_profiles = os.environ.get('CUCLOUD_AWS_USE_NAMED_PROFILE')
 
+        aws_profile_name = None
         # support for lazy setting of the env variable
         if self.use_named_profiles.lower() in ("yes", "true", "y", "t", "1"):
             # select our connection profile, https://github.com/boto/boto3/pull/69
             # which AWS account are we going to use
             boto3.setup_default_session(profile_name=profile_name)
+            aws_profile_name = profile_name
             print "Using AWS named profile '" + profile_name + "' with env '" + env_name + "'"
 
-        # Get the service resource.
-        # http://boto3.readthedocs.org/en/latest/guide/dynamodb.html
-        self.dynamodb = boto3.resource('dynamodb')
+        # sessions and clients shared by every service object handed out by this provider
+        self.clients = ClientRegistry(profile_name=aws_profile_name,
+                                      max_pool_connections=max(10, self.max_workers))
+
+        # rate limits set by the environment win over the rate_limits configuration key
+        self._env_rate_limits = None
+        if os.environ.has_key('CUCLOUD_RATE_LIMITS'):
+            self._env_rate_limits = json.loads(os.environ.get('CUCLOUD_RATE_LIMITS'))
+            self.clients.rate_limiter.configure(self._env_rate_limits)
+
+    @property
+    def stats(self):
+        """
+        API call metrics of every client created by this provider
 
-        # our config dict, created on demand with defaults in does not exist in the account
-        self.config = self._get_config(self.profile_name, self.env_name)
+        :return: cucloud.aws.metrics.ApiStats
+        """
+        return self.clients.stats
+
+    @property
+    def dynamodb(self):
+        """
+        DynamoDB service resource, created on first use
+        http://boto3.readthedocs.org/en/latest/guide/dynamodb.html
+        """
+        return self.clients.resource('dynamodb')
 
     @property
     def config(self):
-        """currently active configuration (json)"""
+        """
+        currently active configuration (json)
+        loaded on first access, created with defaults if it does not exist in the account
+        """
+        if self._config is None:
+            self._config = self._get_config(self.profile_name, self.env_name)
+            self.apply_rate_limits(self._config)
         return self._config
 
     @config.setter
@@ -49,7 +99,29 @@ class AwsProvider(ProviderBase):
 
     @config.deleter
     def config(self):
-        del self._config
+        # reloaded on next access
+        self._config = None
+
+    def apply_rate_limits(self, config=None):
+        """
+        configure the shared rate limiter from the rate_limits configuration key,
+        e.g. {"ec2": {"read": 20, "write": 5}} requests per second
+
+        :param config: dict configuration, the loaded one (loading it if needed) if not set
+        """
+        if config is None:
+            config = self.config
+        self.clients.rate_limiter.configure(config.get('rate_limits'))
+        self.clients.rate_limiter.configure(self._env_rate_limits)
+
+    def _apply_cached_rate_limits(self):
+        # only what is known without an API call, the loaded or the locally cached configuration
+        config = self._config
+        if config is None:
+            cached = localcache.load_config(self.profile_name, self.env_name, self._region_name())
+            config = cached['config'] if cached else None
+        if config is not None:
+            self.apply_rate_limits(config)
 
     def _find_config_tables(self):
         table_iterator = self.dynamodb.tables.filter(
@@ -102,43 +174,187 @@ class AwsProvider(ProviderBase):
 
         return True
 
+    def _region_name(self):
+        return self.clients.session().region_name
+
     def config_init(self):
+        # skip the ListTables scan once the table is known to exist for this profile/region
+        if localcache.table_known('cucloud_profiles', self.profile_name, self._region_name()):
+            return
+
         tables = self._find_config_tables()
         if not self._table_exists(tables, 'cucloud_profiles'):
             self._create_profiles_table()
 
-    def add_profile(self, profile_name, env_name, json):
+        localcache.remember_table('cucloud_profiles', self.profile_name, self._region_name())
+
+    def _put_config(self, profile_name, env_name, config):
+        """
+        write the whole config document, bumping the item revision
+
+        :return: int new revision
+        """
         table = self.dynamodb.Table('cucloud_profiles')
 
-        response = table.put_item(
-            Item={
+        response = table.update_item(
+            Key={
                 'profile': profile_name,
-                'env': env_name,
-                'config': json
-            }
+                'env': env_name
+            },
+            UpdateExpression='SET #config = :config ADD #revision :one',
+            ExpressionAttributeNames={'#config': 'config', '#revision': 'revision'},
+            ExpressionAttributeValues={':config': config, ':one': 1},
+            ReturnValues='UPDATED_NEW'
         )
 
+        revision = response['Attributes']['revision']
+        localcache.save_config(profile_name, env_name, self._region_name(), revision, config)
+
+        return revision
+
+    def add_profile(self, profile_name, env_name, json):
+        self._put_config(profile_name, env_name, json)
+
     def save_profile(self):
+        self.config_revision = self._put_config(self.profile_name, self.env_name, self.config)
+
+    def _update_config(self, update_expression, names, values, conditions, expected_revision=None):
+        """
+        partial update of the active config item, bumping its revision
+
+        :param update_expression: str SET/REMOVE clauses on #config paths
+        :param conditions: list[str] condition expressions that must all hold
+        :param expected_revision: int only apply if the stored revision still matches
+        """
         table = self.dynamodb.Table('cucloud_profiles')
 
-        response = table.put_item(
-            Item={
+        names = dict(names, **{'#config': 'config', '#revision': 'revision'})
+        values = dict(values, **{':one': 1})
+        conditions = list(conditions)
+
+        if expected_revision is not None:
+            conditions.append('#revision = :expected_revision')
+            values[':expected_revision'] = expected_revision
+
+        kwargs = {}
+        if conditions:
+            kwargs['ConditionExpression'] = ' AND '.join(conditions)
+
+        response = table.update_item(
+            Key={
                 'profile': self.profile_name,
-                'env': self.env_name,
-                'config': self.config
-            }
+                'env': self.env_name
+            },
+            UpdateExpression=update_expression + ' ADD #revision :one',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues='ALL_NEW',
+            **kwargs
         )
 
-    def _get_config(self, profile_name, env_name):
+        # the returned item includes changes made by other writers, keep it as our local copy
+        item = response['Attributes']
+        self.config = item['config']
+        self.config_revision = item['revision']
+        localcache.save_config(self.profile_name, self.env_name, self._region_name(),
+                               self.config_revision, self.config)
+
+    def _config_path(self, keys, names):
+        """
+        :param keys: list[str] path within config
+        :param names: dict ExpressionAttributeNames, extended with placeholders for keys
+        :return: str document path, e.g. #config.#k0.#k1
+        """
+        path = '#config'
+        for i, key in enumerate(keys):
+            names['#k' + str(i)] = key
+            path += '.#k' + str(i)
+
+        return path
+
+    def set_config_value(self, keys, item, expected_revision=None):
+        """
+        set a single (dot notation) config key in place using UpdateItem instead of rewriting the whole config
+
+        :param keys: str dot notation key, e.g. snapshot_policies.longterm
+        :param item: value
+        :param expected_revision: int only apply if the stored revision still matches
+        """
+        parts = keys.split('.')
+
+        # a stale copy is reloaded and the update tried once more
+        for attempt in (1, 2):
+            # find the deepest existing map, missing maps below it are created with the value
+            d = self.config
+            depth = 0
+            while depth < len(parts) - 1 and parts[depth] in d:
+                if not isinstance(d[parts[depth]], dict):
+                    raise ValueError('Config key is not a map', '.'.join(parts[:depth + 1]))
+                d = d[parts[depth]]
+                depth += 1
+
+            value = item
+            for key in reversed(parts[depth + 1:]):
+                value = {key: value}
+
+            names = {}
+            path = self._config_path(parts[:depth + 1], names)
+
+            conditions = []
+            if depth < len(parts) - 1:
+                # don't replace a map another writer created meanwhile
+                conditions.append('attribute_not_exists(' + path + ')')
+
+            try:
+                return self._update_config('SET ' + path + ' = :value', names, {':value': value}, conditions,
+                                           expected_revision=expected_revision)
+            except ClientError as e:
+                if (e.response['Error']['Code'] != 'ConditionalCheckFailedException'
+                        or expected_revision is not None or not conditions or attempt == 2):
+                    raise
+                # our copy was stale, reload it from DynamoDB (a locally cached copy may be just as stale) and try again
+                self._config = self._get_config(self.profile_name, self.env_name, force=True)
+
+    def unset_config_value(self, keys, expected_revision=None):
+        """
+        remove a single (dot notation) config key in place using UpdateItem
+
+        :param keys: str dot notation key
+        :param expected_revision: int only apply if the stored revision still matches
+        """
+        names = {}
+        path = self._config_path(keys.split('.'), names)
+
+        self._update_config('REMOVE ' + path, names, {}, [], expected_revision=expected_revision)
+
+    def _get_config(self, profile_name, env_name, force=False):
         """
         Get the latest configuration stored in DynamoDB
         creates the DynamoDB cucloud_profiles table and initiates default values if needed
 
+        A local copy is kept per profile/env. It is used as is while younger than config_ttl seconds,
+        otherwise only the item revision is read and the full config fetched when it has changed.
+
+        :param force: bool always check the revision in DynamoDB, even if the local copy is younger than config_ttl
         :rtype : dict
         """
+        cached = localcache.load_config(profile_name, env_name, self._region_name())
+        if cached and self.config_ttl and cached['age'] < self.config_ttl and not force:
+            self.config_revision = cached['revision']
+            return cached['config']
+
         self.config_init()
 
-        config = self._fetch_config_from_dynamo(profile_name, env_name)
+        try:
+            config = self._load_config(profile_name, env_name, cached)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            # table was removed since it was remembered, verify/create it again
+            localcache.forget_table('cucloud_profiles', self.profile_name, self._region_name())
+            self.config_init()
+            config = self._load_config(profile_name, env_name, None)
+
         # if config doesn't exist create a default one
         if not config:
 
@@ -153,31 +369,214 @@ class AwsProvider(ProviderBase):
             }
 
             self.add_profile(profile_name, env_name, json_obj)
-            config = self._fetch_config_from_dynamo(profile_name, env_name)
+            config = self._load_config(profile_name, env_name, None)
             if not config:
                 raise Exception('Profile not found and could not be created')
 
         return config
 
-    def _fetch_config_from_dynamo(self, profile_name, env_name):
+    def _load_config(self, profile_name, env_name, cached):
+        """
+        cached config if its revision is still current, otherwise the full config from DynamoDB
+
+        :param cached: dict as returned by localcache.load_config or None
+        :rtype : dict
+        """
+        if cached and cached['revision'] is not None:
+            item = self._fetch_item_from_dynamo(profile_name, env_name, attributes=['revision'])
+            if item and item.get('revision') == cached['revision']:
+                localcache.touch_config(profile_name, env_name, self._region_name())
+                self.config_revision = cached['revision']
+                return cached['config']
+
+        item = self._fetch_item_from_dynamo(profile_name, env_name)
+        if not item:
+            return None
+
+        self.config_revision = item.get('revision')
+        localcache.save_config(profile_name, env_name, self._region_name(), self.config_revision, item['config'])
+
+        return item['config']
+
+    def _fetch_item_from_dynamo(self, profile_name, env_name, attributes=None):
+        """
+        :param attributes: list[str] only read these attributes (projection), default the whole item
+        :return: dict, None if not found
+        """
         table = self.dynamodb.Table('cucloud_profiles')
 
+        kwargs = {}
+        if attributes:
+            names = dict(('#a' + str(i), attribute) for i, attribute in enumerate(attributes))
+            kwargs['ProjectionExpression'] = ', '.join(sorted(names.keys()))
+            kwargs['ExpressionAttributeNames'] = names
+
         response = table.get_item(
             Key={
                 'profile': profile_name,
                 'env': env_name
-            }
+            },
+            **kwargs
         )
 
         if not 'Item' in response:
             return None
 
-        item = response['Item']
+        return response['Item']
+
+    def _fetch_config_from_dynamo(self, profile_name, env_name):
+        item = self._fetch_item_from_dynamo(profile_name, env_name)
+
+        if not item:
+            return None
 
         config = item['config']
 
         return config
 
+    def export_profile(self, profile_name=None):
+        """
+        every env of a profile with a single (paginated) Query on the hash key
+
+        :param profile_name: str default the active profile
+        :return: dict[str, dict] config keyed by env
+        """
+        if not profile_name:
+            profile_name = self.profile_name
+
+        self.config_init()
+        table = self.dynamodb.Table('cucloud_profiles')
+
+        envs = {}
+        kwargs = {}
+        while True:
+            response = table.query(
+                KeyConditionExpression='#profile = :profile',
+                ExpressionAttributeNames={'#profile': 'profile'},
+                ExpressionAttributeValues={':profile': profile_name},
+                **kwargs
+            )
+
+            for item in response['Items']:
+                envs[item['env']] = item['config']
+
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        return envs
+
+    def _batch_get_items(self, keys, attributes=None):
+        """
+        BatchGetItem in chunks of 100 keys, retrying unprocessed keys with backoff
+
+        :param keys: list[tuple] (profile, env)
+        :param attributes: list[str] only read these attributes, default the whole item
+        :return: list[dict] items found
+        """
+        keys = list(set(keys))
+
+        request = {}
+        if attributes:
+            names = dict(('#a' + str(i), attribute) for i, attribute in enumerate(attributes))
+            request['ProjectionExpression'] = ', '.join(sorted(names.keys()))
+            request['ExpressionAttributeNames'] = names
+
+        items = []
+        for i in range(0, len(keys), 100):
+            chunk_request = dict(request, Keys=[{'profile': profile, 'env': env} for profile, env in keys[i:i + 100]])
+            unprocessed = {'cucloud_profiles': chunk_request}
+
+            attempt = 0
+            while unprocessed:
+                if attempt:
+                    self._unprocessed_backoff(attempt)
+                attempt += 1
+
+                response = self.dynamodb.batch_get_item(RequestItems=unprocessed)
+                items.extend(response['Responses'].get('cucloud_profiles', []))
+                unprocessed = response.get('UnprocessedKeys')
+
+        return items
+
+    def _batch_write_items(self, items):
+        """
+        BatchWriteItem put requests in chunks of 25, retrying unprocessed items with backoff
+
+        :param items: list[dict]
+        """
+        for i in range(0, len(items), 25):
+            unprocessed = {'cucloud_profiles': [{'PutRequest': {'Item': item}} for item in items[i:i + 25]]}
+
+            attempt = 0
+            while unprocessed:
+                if attempt:
+                    self._unprocessed_backoff(attempt)
+                attempt += 1
+
+                response = self.dynamodb.batch_write_item(RequestItems=unprocessed)
+                unprocessed = response.get('UnprocessedItems')
+
+    def _unprocessed_backoff(self, attempt, max_attempts=8):
+        if attempt >= max_attempts:
+            raise Exception('DynamoDB batch request still has unprocessed items after ' + str(attempt) + ' attempts')
+        time.sleep(min(5.0, 0.05 * 2 ** attempt))
+
+    def fetch_profiles(self, keys):
+        """
+        many profile/env configs at once using BatchGetItem
+
+        :param keys: list[tuple] (profile, env)
+        :return: dict[str, dict[str, dict]] config keyed by profile, then env
+        """
+        self.config_init()
+
+        bundle = {}
+        for item in self._batch_get_items(keys):
+            bundle.setdefault(item['profile'], {})[item['env']] = item['config']
+
+        return bundle
+
+    def import_bundle(self, bundle):
+        """
+        write a multi profile bundle using BatchWriteItem, bumping each item revision
+
+        :param bundle: dict[str, dict[str, dict]] config keyed by profile, then env
+        :return: int number of configs written
+        """
+        self.config_init()
+
+        keys = [(profile, env) for profile in bundle for env in bundle[profile]]
+
+        # BatchWriteItem can only put whole items, read the current revisions to keep them increasing
+        revisions = {}
+        for item in self._batch_get_items(keys, attributes=['profile', 'env', 'revision']):
+            revisions[(item['profile'], item['env'])] = item.get('revision') or 0
+
+        items = []
+        for profile, env in keys:
+            items.append({
+                'profile': profile,
+                'env': env,
+                'config': bundle[profile][env],
+                'revision': revisions.get((profile, env), 0) + 1
+            })
+
+        self._batch_write_items(items)
+
+        for item in items:
+            localcache.save_config(item['profile'], item['env'], self._region_name(), item['revision'], item['config'])
+            if (item['profile'], item['env']) == (self.profile_name, self.env_name):
+                self.config = item['config']
+                self.config_revision = item['revision']
+
+        return len(items)
+
+    def _print_json(self, obj):
+        # "pretty print"
+        print json.dumps(self.byteify(obj), sort_keys=True,
+                         indent=4, separators=(',', ': '), default=self.decimal_default)
+
     # http://stackoverflow.com/questions/956867/how-to-get-string-objects-instead-of-unicode-ones-from-json-in-python
     def byteify(self, input):
         if isinstance(input, dict):
@@ -228,16 +627,13 @@ class AwsProvider(ProviderBase):
             config_value = args.config_set[1]
 
             eval_config_value = ast.literal_eval(config_value)
-            self.dotn_put(self.config, config_key, eval_config_value)
 
-            return self.save_profile()
+            return self.set_config_value(config_key, eval_config_value, expected_revision=args.config_revision)
 
         elif args.config_unset:
             config_key = args.config_unset[0]
 
-            self.dotn_unset(self.config, config_key)
-
-            return self.save_profile()
+            return self.unset_config_value(config_key, expected_revision=args.config_revision)
 
         elif args.config_import:
 
@@ -253,33 +649,94 @@ class AwsProvider(ProviderBase):
                              indent=4, separators=(',', ': '), default=self.decimal_default)
 
             return True
+
+        elif args.config_export_all:
+
+            self._print_json({self.profile_name: self.export_profile()})
+
+            return True
+
+        elif args.config_export_bundle:
+
+            keys = []
+            for key in args.config_export_bundle:
+                if ':' not in key:
+                    raise ValueError('Expected profile:env', key)
+                keys.append(tuple(key.split(':', 1)))
+
+            self._print_json(self.fetch_profiles(keys))
+
+            return True
+
+        elif args.config_import_bundle:
+
+            bundle = json.loads(args.infile.read(), parse_float=decimal.Decimal)
+            self.import_bundle(bundle)
+
+            return True
         else:
             print 'Unable to handle arguments'
 
         return False
 
-    def compute(self):
+    def compute(self, region_name=None):
         """
+        :param region_name: str region to act on, the default region if not set
         :return: cucloud.aws.compute.Compute
         """
-        c = compute.Compute()
-        c.dry_run = self.dry_run
-        return c
+        if region_name not in self._compute:
+            self._apply_cached_rate_limits()
+            self._compute[region_name] = compute.Compute(clients=self.clients, region_name=region_name)
+        self._compute[region_name].dry_run = self.dry_run
+        return self._compute[region_name]
 
-    def storage(self):
+    def storage(self, region_name=None):
         """
+        :param region_name: str region to act on, the default region if not set
         :return: cucloud.aws.storage.Storage
         """
-        s = storage.Storage()
-        s.dry_run = self.dry_run
-        return s
+        if region_name not in self._storage:
+            self._apply_cached_rate_limits()
+            self._storage[region_name] = storage.Storage(clients=self.clients, region_name=region_name)
+        self._storage[region_name].dry_run = self.dry_run
+        self._storage[region_name].max_workers = self.max_workers
+        return self._storage[region_name]
+
+    def region_names(self):
+        """
+        :return: list[str] every region supporting EC2
+        """
+        return [region['RegionName'] for region in self.compute().region_list()]
+
+    def for_regions(self, service_name, operation, RegionNames=None, max_workers=None, args=(), kwargs=None):
+        """
+        run a compute or storage operation against many regions in parallel, each with its own region's clients
+
+        e.g. provider.for_regions('storage', 'find_old_snapshots', ['us-east-1', 'us-west-2'],
+                                  kwargs={'snapshot_policy': policy})
+
+        :param service_name: str 'compute' or 'storage'
+        :param operation: callable taking the Compute/Storage object, or str name of one of its methods
+        :param RegionNames: list[str] every EC2 region if not set
+        :param max_workers: int regions run at once, all of them if not set
+        :return: cucloud.aws.regions.RegionResults
+        """
+        if service_name not in ('compute', 'storage'):
+            raise ValueError('Expected compute or storage', service_name)
+
+        if RegionNames is None:
+            RegionNames = self.region_names()
+
+        return regions.fan_out(getattr(self, service_name), operation, RegionNames,
+                               max_workers=max_workers, args=args, kwargs=kwargs)
 
     def dns(self):
         """
         :return: cucloud.aws.dns.Dns
         """
-        d = dns.Dns()
-        return d
+        if not self._dns:
+            self._dns = dns.Dns(clients=self.clients)
+        return self._dns
 
     def decimal_default(self, obj):
         if isinstance(obj, decimal.Decimal):
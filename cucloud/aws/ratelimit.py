@@ -0,0 +1,172 @@
+import logging
+import random
+import threading
+import time
+from cucloud.aws.errors import is_throttle
+
+__author__ = 'emg33'
+
+# requests per second per (service, operation class), roughly the documented refill rates
+DEFAULT_RATES = {'default': {'read': 10, 'write': 5},
+                 'ec2': {'read': 20, 'write': 5},
+                 'elb': {'read': 10, 'write': 5},
+                 'route53': {'read': 5, 'write': 3},
+                 'dynamodb': {'read': 50, 'write': 25}}
+
+# operations with these prefixes are counted as reads, everything else as writes
+READ_PREFIXES = ('Describe', 'List', 'Get', 'BatchGet', 'Query', 'Scan')
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket with AIMD rate adaptation: the rate is halved on a throttle response
+    (at most once per second, so a burst of throttles counts once) and grows back additively on success.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.5, increase=None):
+        """
+        :param rate: float max (and initial) requests per second
+        :param burst: float bucket size, defaults to one second worth of requests
+        :param min_rate: float the rate is never decreased below
+        :param increase: float rate added per successful request, defaults to 2% of rate
+        """
+        self._lock = threading.Lock()
+        self.min_rate = min_rate
+        self.configure(rate, burst=burst, increase=increase)
+        self.tokens = self.burst
+        self._updated = time.time()
+        self._decreased = 0
+
+    def configure(self, rate, burst=None, increase=None):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = float(burst) if burst else max(1.0, self.max_rate)
+        self.increase = float(increase) if increase else self.max_rate * 0.02
+
+    def _refill(self, now):
+        # caller holds the lock
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        block until a request may be sent
+
+        :return: float seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                # jitter so workers released by the same refill do not fire in lockstep
+                delay = (1 - self.tokens) / self.rate * random.uniform(1, 1.5)
+
+            time.sleep(delay)
+            waited += delay
+
+    def throttled(self):
+        with self._lock:
+            now = time.time()
+            if now - self._decreased < 1:
+                return
+            self._decreased = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            # drain the bucket so every worker backs off
+            self._refill(now)
+            self.tokens = min(self.tokens, 0)
+            logging.info('Throttled, rate decreased to %.2f/s', self.rate)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class RateLimiter(object):
+    """
+    Process wide request rate limits per (service, region, read/write), shared by every instrumented client.
+    AWS applies API request limits per account and region, so regions do not share a bucket.
+
+    Each attempt, retries included, takes a token before it is signed and sent. Throttle responses
+    decrease the rate of the bucket, successful calls increase it back towards the configured rate.
+    """
+
+    def __init__(self, rates=None):
+        """
+        :param rates: dict service -> {'read': float, 'write': float} overriding DEFAULT_RATES
+        """
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.rates = {}
+        for service_name, rate in DEFAULT_RATES.items():
+            self.rates[service_name] = dict(rate)
+        self.configure(rates)
+
+    def configure(self, rates):
+        """
+        :param rates: dict service -> {'read': float, 'write': float}, e.g. the profile config key rate_limits
+        """
+        if not rates:
+            return
+
+        with self._lock:
+            for service_name, rate in rates.items():
+                service_rates = self.rates.setdefault(service_name, dict(self.rates['default']))
+                for operation_class in ('read', 'write'):
+                    if operation_class not in rate:
+                        continue
+                    service_rates[operation_class] = float(rate[operation_class])
+
+                    for key, bucket in self._buckets.items():
+                        if key[0] == service_name and key[2] == operation_class:
+                            bucket.configure(service_rates[operation_class])
+
+    def bucket(self, service_name, operation_name, region_name=None):
+        """
+        :return: TokenBucket shared by every call of this service, region and operation class
+        """
+        operation_class = 'read' if operation_name.startswith(READ_PREFIXES) else 'write'
+        key = (service_name, region_name, operation_class)
+
+        with self._lock:
+            if key not in self._buckets:
+                rates = self.rates.get(service_name, self.rates['default'])
+                self._buckets[key] = TokenBucket(rates[operation_class])
+            return self._buckets[key]
+
+    def instrument(self, client):
+        """
+        register the rate limit hooks on a client
+
+        :param client: botocore.client.BaseClient
+        :return: client
+        """
+        service_name = client.meta.service_model.service_name
+        region_name = client.meta.region_name
+        events = client.meta.events
+
+        def request_created(operation_name, **kwargs):
+            self.bucket(service_name, operation_name, region_name).acquire()
+
+        def needs_retry(response, operation, **kwargs):
+            # only observe, returning None leaves the retry decision and its jittered delay to botocore
+            if response and response[1] and is_throttle(response[1].get('Error', {}).get('Code')):
+                self.bucket(service_name, operation.name, region_name).throttled()
+
+        def after_call(parsed, model, **kwargs):
+            if parsed and 'Error' not in parsed:
+                self.bucket(service_name, model.name, region_name).succeeded()
+
+        # wait before the request is signed, so a long wait does not outdate the signature
+        events.register_first('request-created.*.*', request_created, unique_id='cucloud-rate-limit-request')
+        events.register('needs-retry.*.*', needs_retry, unique_id='cucloud-rate-limit-needs-retry')
+        events.register('after-call.*.*', after_call, unique_id='cucloud-rate-limit-after-call')
+
+        return client
+
+
+# shared by every ClientRegistry of the process unless one is given its own
+shared_limiter = RateLimiter()
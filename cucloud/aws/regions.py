@@ -0,0 +1,78 @@
+from cucloud.aws import parallel
+
+__author__ = 'emg33'
+
+
+class RegionResults(object):
+    """
+    Outcome of one operation fanned out over regions: results and errors keyed by region name.
+    A failing region does not affect the others, its exception is kept in errors.
+    """
+
+    def __init__(self, RegionNames, outcomes):
+        """
+        :param RegionNames: list[str]
+        :param outcomes: list[tuple] of (result, exception) in RegionNames order
+        """
+        self.regions = list(RegionNames)
+        self.results = {}
+        self.errors = {}
+        for region_name, (result, error) in zip(self.regions, outcomes):
+            if error:
+                self.errors[region_name] = error
+            else:
+                self.results[region_name] = result
+
+    def __iter__(self):
+        """
+        :return: iterator of (region_name, result, error) in region order
+        """
+        for region_name in self.regions:
+            yield region_name, self.results.get(region_name), self.errors.get(region_name)
+
+    def succeeded(self):
+        return not self.errors
+
+    def merged(self):
+        """
+        results of operations returning lists, flattened with the region of each item
+
+        :return: list[tuple] of (region_name, item)
+        """
+        items = []
+        for region_name in self.regions:
+            for item in self.results.get(region_name) or []:
+                items.append((region_name, item))
+        return items
+
+
+def fan_out(factory, operation, RegionNames, max_workers=None, args=(), kwargs=None):
+    """
+    run an operation against every region in parallel, wall time is that of the slowest region
+
+    :param factory: callable returning the service object (e.g. Compute, Storage) bound to a region name
+    :param operation: callable taking the service object, or str name of one of its methods
+    :param RegionNames: list[str]
+    :param max_workers: int regions run at once, all of them if not set
+    :param args: tuple positional arguments of operation
+    :param kwargs: dict keyword arguments of operation
+    :return: RegionResults
+    """
+    RegionNames = list(RegionNames)
+    if kwargs is None:
+        kwargs = {}
+
+    # created up front in the calling thread, factories like AwsProvider.storage cache without locking
+    services = {}
+    for region_name in RegionNames:
+        services[region_name] = factory(region_name)
+
+    def run(region_name):
+        service = services[region_name]
+        if callable(operation):
+            return operation(service, *args, **kwargs)
+        return getattr(service, operation)(*args, **kwargs)
+
+    outcomes = parallel.map_ordered(run, RegionNames, max_workers=max_workers or len(RegionNames))
+
+    return RegionResults(RegionNames, outcomes)
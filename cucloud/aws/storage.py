@@ -2,7 +2,20 @@ import boto3
 import boto3.utils
 import abc
 import datetime
+import Queue
+import threading
+import time
+from botocore.exceptions import ClientError
+from cucloud.aws import localcache
+from cucloud.aws import parallel
+from cucloud.aws.catalog import SnapshotCatalog
+from cucloud.aws.clients import ClientRegistry
+from cucloud.aws.errors import is_dry_run
+from cucloud.aws.tagging import TagWriter
+from cucloud.aws.waiters import SnapshotTracker
+from cucloud import retention
 from cucloud.storage import StorageBase
+from dateutil.tz import tzlocal
 
 __author__ = 'emg33'
 
@@ -10,13 +23,98 @@ __author__ = 'emg33'
 class Storage(StorageBase):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self):
+    def __init__(self, clients=None, region_name=None):
+        """
+        :param clients: cucloud.aws.clients.ClientRegistry shared clients, a private registry if not set
+        :param region_name: str region to act on, the registry default if not set
+        """
         super(Storage, self).__init__()
 
+        if clients is None:
+            clients = ClientRegistry()
+        self.clients = clients
+
         # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#client
-        self.ec2client = boto3.client('ec2')
+        self.ec2client = clients.client('ec2', region_name=region_name)
         # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#service-resource
-        self.ec2resource = boto3.resource('ec2')
+        self.ec2resource = clients.resource('ec2', region_name=region_name)
+        self.region_name = self.ec2client.meta.region_name
+
+        # number of worker threads used by bulk operations, 1 runs serially
+        self.max_workers = 1
+        # per item errors of the last parallel bulk operation, in input order, None on success
+        self.last_errors = []
+        self._tagger = None
+        self._tracker = None
+        # local snapshot catalog answering snapshot queries, see use_catalog()
+        self.catalog = None
+
+    def use_catalog(self, path=None, max_age=3600):
+        """
+        answer snapshot queries from a persistent local SQLite catalog instead of describe_snapshots
+
+        :param path: str database file, defaults to one per profile and region in the cucloud cache directory
+        :param max_age: int seconds the catalog may be stale before it is refreshed
+        :return: cucloud.aws.catalog.SnapshotCatalog
+        """
+        if path is None:
+            path = localcache.cache_path('snapshots', self.clients.profile_name or 'default',
+                                         self.region_name) + '.sqlite'
+
+        self.catalog = SnapshotCatalog(self.ec2client, path, max_age=max_age)
+        return self.catalog
+
+    @property
+    def snapshot_tracker(self):
+        """
+        shared snapshot completion tracker, created on first use
+
+        :return: cucloud.aws.waiters.SnapshotTracker
+        """
+        if not self._tracker:
+            self._tracker = SnapshotTracker(self.ec2client)
+        return self._tracker
+
+    def wait_for_snapshots(self, Snapshots, callback=None, report_interval=30):
+        """
+        block until the snapshots completed, polling all of them with batched describe_snapshots calls
+
+        :param Snapshots: list[EC2.Snapshot] or list[str] SnapshotIds, False entries (failed creates) are skipped
+        :param callback: callable called with each snapshot's future once it completed or failed
+        :return: dict with 'completed' and 'failed' SnapshotIds, 'errors' the failure reason keyed by SnapshotId
+        """
+        SnapshotIds = [getattr(Snapshot, 'id', Snapshot) for Snapshot in Snapshots if Snapshot]
+
+        def report(done, total, progress):
+            print "Snapshots completed: " + str(done) + "/" + str(total)
+
+        self.snapshot_tracker.track(SnapshotIds, callback=callback)
+
+        return self.snapshot_tracker.wait_all(progress=report, report_interval=report_interval)
+
+    @property
+    def tagger(self):
+        """
+        coalescing tag writer shared by bulk tagging, created on first use
+
+        :return: cucloud.aws.tagging.TagWriter
+        """
+        if not self._tagger:
+            self._tagger = TagWriter(self.ec2client)
+        self._tagger.dry_run = self.dry_run
+        return self._tagger
+
+    def tag_snapshots(self, SnapshotIds, Tags, flush=True):
+        """
+        tag many snapshots, batched with any other pending tag writes sharing the same tags
+
+        :param SnapshotIds: list[str]
+        :param Tags: list[dict]
+        :param flush: bool write now, otherwise left to the tagger size/time thresholds
+        """
+        self.tagger.add(SnapshotIds, Tags)
+        if flush:
+            self.tagger.flush()
 
     def get_name_given_tags(self, tags):
         if not tags:
@@ -41,109 +139,317 @@ class Storage(StorageBase):
 
         return Instance.volumes.all()
 
-    def create_snapshot_volume(self, Volume=None, VolumeId=None, snapshot_tag=None):
+    def get_volume_tags(self, VolumeIds):
         """
-        :param volume: EC2.volume
-        :return: EC2.Snapshot
+        tags of many volumes using batched describe_volumes calls
+
+        :param VolumeIds: list[str]
+        :return: dict[str, list[dict]] keyed by VolumeId
         """
-        if not Volume and not VolumeId:
-            raise Exception('Volume or VolumeId is required')
-        if not Volume:
-            Volume = self.ec2resource.Volume(VolumeId)
+        VolumeIds = list(VolumeIds)
+        volume_tags = {}
 
-        # TODO: is this a root device? if, really should handle differently or at least warn
+        for i in range(0, len(VolumeIds), 200):
+            response = self.ec2client.describe_volumes(VolumeIds=VolumeIds[i:i + 200])
+            for volume in response['Volumes']:
+                volume_tags[volume['VolumeId']] = volume.get('Tags') or []
 
-        # create the description, using today's date
+        return volume_tags
+
+    def get_snapshot_description(self, name):
+        """
+        :param name: str, e.g. the source volume Name tag
+        :return: str concat(name,-,YYYY-MM-DD) using today's date
+        """
         now = datetime.datetime.today()
 
-        descr = self.get_name_given_tags(Volume.tags)
+        descr = name or ''
         if len(descr):
             descr += '-'
         descr += now.strftime('%Y-%m-%d')
 
-        # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#snapshot
-        try:
-            Snapshot = self.ec2resource.create_snapshot(
-                VolumeId=Volume.id,
-                Description=descr,
-                DryRun=self.dry_run
-            )
+        return descr
 
-            # FIXME: waiter isnt responding correctly.
-            # create a waiter until this is complete
-            #waiter = self.ec2client.get_waiter('volume_available')
-            #waiter.wait(
-            #   VolumeIds=[volume.id]
-            #)
+    def get_snapshot_tag_specifications(self, tags=None, snapshot_tag=None):
+        """
+        TagSpecifications tagging a snapshot on create with the source volume tags plus cucloud-snapshot
+
+        :param tags: list[dict]
+        :return: list[dict], empty if there is nothing to tag
+        """
+        # aws: prefixed tags are reserved and can't be set
+        snaptags = [tag for tag in tags or [] if not tag['Key'].startswith('aws:')]
+        if snapshot_tag:
+            snaptags.append({'Key': 'cucloud-snapshot', 'Value': snapshot_tag.lower()})
+
+        if not snaptags:
+            return []
+
+        return [{'ResourceType': 'snapshot', 'Tags': snaptags}]
+
+    def _snapshot_volume(self, VolumeId, tags, snapshot_tag=None):
+        """
+        snapshot a single volume, tagged on create with its tags, using only the (thread safe) client,
+        raises on failure, including DryRunOperation
+
+        :param VolumeId: str
+        :param tags: list[dict] tags of the source volume
+        :return: str SnapshotId
+        """
+        # TODO: is this a root device? if, really should handle differently or at least warn
 
-            print "Snapshot initiated " + Snapshot.id + " from " + Volume.id
-            print "  set description '" + descr + "'"
+        descr = self.get_snapshot_description(self.get_name_given_tags(tags))
 
-            voltags = Volume.tags
-            if not Volume.tags:
-                voltags = []
-            if snapshot_tag:
-                voltags.append({'Key': 'cucloud-snapshot', 'Value': snapshot_tag.lower()})
+        kwargs = {}
+        tag_specifications = self.get_snapshot_tag_specifications(tags, snapshot_tag)
+        if tag_specifications:
+            kwargs['TagSpecifications'] = tag_specifications
 
-            # set tags on the new snapshot
-            if voltags:
-                self.ec2client.create_tags(
-                    Resources=[Snapshot.id],
-                    Tags=voltags
-                )
+        # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.create_snapshot
+        response = self.ec2client.create_snapshot(
+            VolumeId=VolumeId,
+            Description=descr,
+            DryRun=self.dry_run,
+            **kwargs
+        )
+        SnapshotId = response['SnapshotId']
 
-            return Snapshot
+        # completion is tracked in bulk, see wait_for_snapshots()
 
-        except Exception:
+        print "Snapshot initiated " + SnapshotId + " from " + VolumeId
+        print "  set description '" + descr + "'"
+
+        return SnapshotId
+
+    def _snapshot_instance(self, InstanceId, snapshot_tag=None):
+        """
+        crash-consistent snapshots of all volumes attached to an instance with a single CreateSnapshots,
+        volume tags are copied and cucloud-snapshot added on create, raises on failure
+
+        :param InstanceId: str
+        :return: list[str] SnapshotIds
+        """
+        descr = self.get_snapshot_description(InstanceId)
+
+        kwargs = {}
+        tag_specifications = self.get_snapshot_tag_specifications(snapshot_tag=snapshot_tag)
+        if tag_specifications:
+            kwargs['TagSpecifications'] = tag_specifications
+
+        # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.create_snapshots
+        response = self.ec2client.create_snapshots(
+            InstanceSpecification={
+                'InstanceId': InstanceId,
+                'ExcludeBootVolume': False
+            },
+            Description=descr,
+            CopyTagsFromSource='volume',
+            DryRun=self.dry_run,
+            **kwargs
+        )
+
+        SnapshotIds = []
+        for snapshot in response['Snapshots']:
+            print "Snapshot initiated " + snapshot['SnapshotId'] + " from " + snapshot['VolumeId']
+            SnapshotIds.append(snapshot['SnapshotId'])
+        print "  set description '" + descr + "'"
+
+        return SnapshotIds
+
+    def create_snapshot_volume(self, Volume=None, VolumeId=None, snapshot_tag=None):
+        """
+        :param volume: EC2.volume
+        :return: EC2.Snapshot
+        """
+        if not Volume and not VolumeId:
+            raise Exception('Volume or VolumeId is required')
+        if not Volume:
+            Volume = self.ec2resource.Volume(VolumeId)
+
+        try:
+            SnapshotId = self._snapshot_volume(Volume.id, Volume.tags, snapshot_tag=snapshot_tag)
+
+            return self.ec2resource.Snapshot(SnapshotId)
+
+        except ClientError as e:
+            if not is_dry_run(e):
+                raise
             print "DRY-RUN Creating snapshot"
-            pass
 
         return False
 
-    def create_snapshot_volumes(self, Volumes=None, VolumeIds=None, snapshot_tag=None):
+    def create_snapshot_volumes(self, Volumes=None, VolumeIds=None, snapshot_tag=None, max_workers=None):
         """
         :param volumes: list[EC2.Volume]
-        :return: list[EC2.Snapshot]
+        :param max_workers: int snapshot volumes in parallel using this many threads, default self.max_workers
+        :return: list[EC2.Snapshot], False in place of any volume that failed
         """
         if not Volumes and not VolumeIds:
             raise Exception('Volumes or VolumeIds is required')
-        if not Volumes:
-            Volumes = []
+
+        if max_workers is None:
+            max_workers = self.max_workers
+        if not VolumeIds:
+            VolumeIds = [Volume.id for Volume in Volumes]
+
+        # one batched describe instead of a lazy load per volume, serial and parallel runs fail alike
+        return self._create_snapshots(VolumeIds, self.get_volume_tags(VolumeIds), snapshot_tag, max_workers)
+
+    def _create_snapshots(self, VolumeIds, volume_tags, snapshot_tag, max_workers):
+        """
+        snapshot volumes whose tags are already known, using a bounded thread pool when max_workers > 1,
+        a failing volume does not abort the batch, its error is kept in self.last_errors at the same position
+
+        :param volume_tags: dict[str, list[dict]] tags keyed by VolumeId
+        :return: list[EC2.Snapshot], False in place of any volume that failed
+        """
+        def snapshot(VolumeId):
+            return self._snapshot_volume(VolumeId, volume_tags.get(VolumeId), snapshot_tag=snapshot_tag)
+
+        if max_workers > 1:
+            results = parallel.map_ordered(snapshot, VolumeIds, max_workers)
+        else:
+            results = []
             for VolumeId in VolumeIds:
-                Volume = self.ec2resource.Volume(VolumeId)
-                Volumes.append(Volume)
+                try:
+                    results.append((snapshot(VolumeId), None))
+                except Exception as e:
+                    results.append((None, e))
 
         Snapshots = []
-        for Volume in Volumes:
-            Snapshot = self.create_snapshot_volume(Volume, snapshot_tag=snapshot_tag)
-            Snapshots.append(Snapshot)
+        self.last_errors = []
+        for VolumeId, (SnapshotId, error) in zip(VolumeIds, results):
+            self.last_errors.append(error)
+            if error:
+                if is_dry_run(error):
+                    print "DRY-RUN Creating snapshot from " + VolumeId
+                else:
+                    print "Failed creating snapshot from " + VolumeId + ": " + str(error)
+                Snapshots.append(False)
+            else:
+                Snapshots.append(self.ec2resource.Snapshot(SnapshotId))
 
         return Snapshots
 
-    def create_snapshot_all_instance_volumes(self, snapshot_tag=None, Instance=None, InstanceId=None):
+    def _create_instance_snapshots(self, InstanceIds, snapshot_tag, max_workers):
+        """
+        one CreateSnapshots per instance, instances in parallel when max_workers > 1
+
+        :return: list[EC2.Snapshot], False in place of any instance that failed
+        """
+        def snapshot(InstanceId):
+            return self._snapshot_instance(InstanceId, snapshot_tag=snapshot_tag)
+
+        if max_workers > 1:
+            results = parallel.map_ordered(snapshot, InstanceIds, max_workers)
+        else:
+            results = []
+            for InstanceId in InstanceIds:
+                try:
+                    results.append((snapshot(InstanceId), None))
+                except Exception as e:
+                    results.append((None, e))
+
+        Snapshots = []
+        self.last_errors = []
+        for InstanceId, (SnapshotIds, error) in zip(InstanceIds, results):
+            self.last_errors.append(error)
+            if error:
+                if is_dry_run(error):
+                    print "DRY-RUN Creating snapshots of " + InstanceId
+                else:
+                    print "Failed creating snapshots of " + InstanceId + ": " + str(error)
+                Snapshots.append(False)
+            else:
+                Snapshots.extend(self.ec2resource.Snapshot(SnapshotId) for SnapshotId in SnapshotIds)
+
+        return Snapshots
+
+    def describe_instances_volumes(self, InstanceIds):
+        """
+        volumes attached to many instances using describe_volumes filtered on attachment.instance-id,
+        200 instance ids per filter, instead of loading every instance and its volumes
+
+        :param InstanceIds: list[str]
+        :return: list[dict] as returned by describe_volumes (VolumeId, Tags, Attachments, ...), ordered by instance
+        """
+        InstanceIds = list(InstanceIds)
+        order = dict((InstanceId, i) for i, InstanceId in enumerate(InstanceIds))
+
+        volumes = {}
+        paginator = self.ec2client.get_paginator('describe_volumes')
+        for i in range(0, len(InstanceIds), 200):
+            pages = paginator.paginate(
+                Filters=[{'Name': 'attachment.instance-id', 'Values': InstanceIds[i:i + 200]}]
+            )
+            for page in pages:
+                for volume in page['Volumes']:
+                    volumes[volume['VolumeId']] = volume
+
+        def sort_key(volume):
+            attached = [order[a['InstanceId']] for a in volume.get('Attachments') or [] if a['InstanceId'] in order]
+            return min(attached or [len(order)]), volume['VolumeId']
+
+        return sorted(volumes.values(), key=sort_key)
+
+    def create_snapshot_all_instance_volumes(self, snapshot_tag=None, Instance=None, InstanceId=None, max_workers=None,
+                                             multi_volume=False):
+        """
+        :param multi_volume: bool snapshot all volumes with one CreateSnapshots request
+        :return: list[EC2.Snapshot]
+        """
         if not Instance and not InstanceId:
             raise Exception('Instance or InstanceId must be set')
 
-        if not Instance:
-            Instance = self.ec2resource.Instance(InstanceId)
-
-        volumes = self.get_instance_volumes(Instance=Instance)
+        if not InstanceId:
+            InstanceId = Instance.id
 
-        snapshots = self.create_snapshot_volumes(Volumes=volumes, snapshot_tag=snapshot_tag)
+        snapshots = self.create_snapshot_all_instances_volumes(snapshot_tag=snapshot_tag, InstanceIds=[InstanceId],
+                                                               max_workers=max_workers, multi_volume=multi_volume)
 
         return snapshots
 
-    def create_snapshot_all_instances_volumes(self, snapshot_tag=None, InstanceIds=None):
+    def create_snapshot_all_instances_volumes(self, snapshot_tag=None, InstanceIds=None, max_workers=None,
+                                              multi_volume=False):
+        """
+        volumes of all instances are found with batched describe_volumes calls (about one per 200 instances)
+
+        :param max_workers: int snapshot volumes in parallel using this many threads, default self.max_workers
+        :param multi_volume: bool one CreateSnapshots request per instance instead of one CreateSnapshot per volume,
+                             self.last_errors is then kept per instance
+        :return: list[EC2.Snapshot], False in place of any volume (or with multi_volume instance) that failed
+        """
         if not InstanceIds:
             raise Exception('InstanceIds required')
 
-        snapshots = []
+        if max_workers is None:
+            max_workers = self.max_workers
 
-        for InstanceId in InstanceIds:
-            instance_snapshots = self.create_snapshot_all_instance_volumes(snapshot_tag=snapshot_tag, InstanceId=InstanceId)
-            snapshots = snapshots + instance_snapshots
+        if multi_volume:
+            return self._create_instance_snapshots(InstanceIds, snapshot_tag, max_workers)
 
-        return snapshots
+        volumes = self.describe_instances_volumes(InstanceIds)
+
+        VolumeIds = [volume['VolumeId'] for volume in volumes]
+        volume_tags = dict((volume['VolumeId'], volume.get('Tags') or []) for volume in volumes)
+
+        return self._create_snapshots(VolumeIds, volume_tags, snapshot_tag, max_workers)
+
+    def _delete_snapshot(self, SnapshotId):
+        """
+        client-only delete, safe to call from worker threads, raises on failure including DryRunOperation
+
+        :param SnapshotId: string
+        :return: response
+        """
+        response = self.ec2client.delete_snapshot(
+            SnapshotId=SnapshotId,
+            DryRun=self.dry_run
+        )
+        if self.catalog:
+            self.catalog.forget([SnapshotId])
+        print "Deleting: " + SnapshotId
+        return response
 
     def delete_snapshot(self, SnapshotId):
         """
@@ -151,13 +457,10 @@ class Storage(StorageBase):
         :return: response
         """
         try:
-            response = self.ec2client.delete_snapshot(
-                SnapshotId=SnapshotId,
-                DryRun=self.dry_run
-            )
-            print "Deleting: " + SnapshotId
-            return response
-        except Exception:
+            return self._delete_snapshot(SnapshotId)
+        except ClientError as e:
+            if not is_dry_run(e):
+                raise
             print "DRY-RUN Deleting: " + SnapshotId
 
         print ""
@@ -177,51 +480,266 @@ class Storage(StorageBase):
 
         return True
 
-    def find_old_snapshots(self, snapshot_policy=None, VolumeIds=None):
-        self.verify_snapshot_policy(snapshot_policy)
+    def get_snapshot_tag(self, tags):
+        """
+        :param tags: list[dict]
+        :return: str cucloud-snapshot tag value, None if not tagged
+        """
+        if not tags:
+            return None
+        for tag in tags:
+            if tag['Key'] == 'cucloud-snapshot':
+                return tag['Value'].lower()
 
-        oldsnapshots = []
+        return None
 
-        # using keys
-        for snapshot_tag in ['daily', 'weekly', 'monthly', 'yearly']:
+    def iter_snapshot_pages(self, snapshot_tags=None):
+        """
+        Single paginated sweep over all completed cucloud-snapshot tagged snapshots owned by the account,
+        yielding each page as it arrives
 
-            policy_value = snapshot_policy[snapshot_tag]
-            if policy_value == 0:
-                continue
+        :param snapshot_tags: list[str] limit to these cucloud-snapshot tag values, default all
+        :return: generator of list[dict]
+        """
+        if snapshot_tags:
+            tag_filter = {'Name': 'tag:cucloud-snapshot', 'Values': snapshot_tags}
+        else:
+            tag_filter = {'Name': 'tag-key', 'Values': ['cucloud-snapshot']}
+
+        # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Paginator.DescribeSnapshots
+        paginator = self.ec2client.get_paginator('describe_snapshots')
+        pages = paginator.paginate(
+            OwnerIds=['self'],
+            Filters=[
+                {'Name': 'status',
+                 'Values': ['completed']
+                 },
+                tag_filter
+            ]
+        )
+
+        for page in pages:
+            yield page['Snapshots']
+
+    def _volume_snapshots(self, VolumeId, snapshot_tag):
+        """
+        all completed snapshots of a single volume with the given cucloud-snapshot tag, following pagination
+
+        :return: generator of dict
+        """
+        paginator = self.ec2client.get_paginator('describe_snapshots')
+        pages = paginator.paginate(
+            Filters=[
+                {'Name': 'volume-id',
+                 'Values': [VolumeId]
+                 },
+                {'Name': 'status',
+                 'Values': ['completed']
+                 },
+                {'Name': 'tag:cucloud-snapshot',
+                 'Values': [snapshot_tag]}
+            ]
+        )
+
+        for page in pages:
+            for snapshot in page['Snapshots']:
+                yield snapshot
+
+    def _policy_snapshot_tags(self, snapshot_policy):
+        self.verify_snapshot_policy(snapshot_policy)
 
-            # calculate old_dttm based on snapshot_tag and snapshot_policy[snapshot_tag]
-            consider_old_dttm = self.get_old_dttm(snapshot_tag, snapshot_policy[snapshot_tag])
+        # only tags with an active policy need to be looked at
+        return [t for t in ['daily', 'weekly', 'monthly', 'yearly'] if snapshot_policy[t] != 0]
 
-            # find all snapshots for each of the VolumeIds
-            # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.describe_snapshots
-            for VolumeId in VolumeIds:
-                response = self.ec2client.describe_snapshots(
-                    Filters=[
-                        {'Name': 'volume-id',
-                         'Values': [VolumeId]
-                         },
-                        {'Name': 'status',
-                         'Values': ['completed']
-                         },
-                        {'Name': 'tag:cucloud-snapshot',
-                         'Values': [snapshot_tag]}
-                    ]
-                )
-
-                snapshots = response['Snapshots']
+    def _iter_tagged_snapshots(self, snapshot_tags, VolumeIds=None, account_wide=False):
+        """
+        yields (snapshot_tag, snapshot) for every snapshot carrying one of snapshot_tags,
+        from the local catalog once use_catalog() was called
+        """
+        if self.catalog:
+            self.catalog.ensure_fresh()
+            for snapshot_tag in snapshot_tags:
+                for snapshot in self.catalog.snapshots(VolumeIds=VolumeIds, snapshot_tag=snapshot_tag):
+                    yield snapshot_tag, snapshot
+            return
+
+        if account_wide or VolumeIds is None:
+            if VolumeIds is not None:
+                VolumeIds = set(VolumeIds)
+
+            for snapshots in self.iter_snapshot_pages(snapshot_tags=snapshot_tags):
                 for snapshot in snapshots:
-                    snapshot_dttm = snapshot['StartTime']
-                    # are we older than ... OR keep none
-                    if snapshot_dttm <= consider_old_dttm or policy_value == -1:
-                        oldsnapshots.append(snapshot)
+                    if VolumeIds is not None and snapshot['VolumeId'] not in VolumeIds:
+                        continue
 
-        return oldsnapshots
+                    snapshot_tag = self.get_snapshot_tag(snapshot.get('Tags'))
+                    if snapshot_tag in snapshot_tags:
+                        yield snapshot_tag, snapshot
+            return
 
-    def delete_old_snapshots(self, snapshot_policy=None, VolumeIds=None):
-        oldsnapshots = self.find_old_snapshots(snapshot_policy=snapshot_policy, VolumeIds=VolumeIds)
+        # find all snapshots for each of the VolumeIds
+        # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Client.describe_snapshots
+        for snapshot_tag in snapshot_tags:
+            for VolumeId in VolumeIds:
+                for snapshot in self._volume_snapshots(VolumeId, snapshot_tag):
+                    yield snapshot_tag, snapshot
+
+    def iter_old_snapshots(self, snapshot_policy=None, VolumeIds=None, account_wide=False, as_of=None):
+        """
+        yields snapshots to be expired by the policy as describe_snapshots pages arrive,
+        or from the local catalog once use_catalog() was called
+
+        :param snapshot_policy: dict
+        :param VolumeIds: list[str] volumes to consider, all account volumes if not set
+        :param account_wide: bool use a single account-wide sweep instead of querying each volume
+        :param as_of: datetime reference time for every cutoff, now if not set
+        :return: generator of dict
+        """
+        snapshot_tags = self._policy_snapshot_tags(snapshot_policy)
+        if not snapshot_tags:
+            return
+
+        if as_of is None:
+            as_of = datetime.datetime.now(tzlocal())
+
+        # calculate old_dttm based on snapshot_tag and snapshot_policy[snapshot_tag]
+        old_dttms = {}
+        for snapshot_tag in snapshot_tags:
+            old_dttms[snapshot_tag] = self.get_old_dttm(snapshot_tag, snapshot_policy[snapshot_tag], now_dttm=as_of)
+
+        for snapshot_tag, snapshot in self._iter_tagged_snapshots(snapshot_tags, VolumeIds, account_wide):
+            # are we older than ... OR keep none
+            if snapshot['StartTime'] <= old_dttms[snapshot_tag] or snapshot_policy[snapshot_tag] == -1:
+                yield snapshot
+
+    def plan_old_snapshots(self, snapshot_policy=None, VolumeIds=None, account_wide=False, as_of=None):
+        """
+        collect the tagged snapshots once and evaluate the policy over all of them at a single as-of time
+
+        :param snapshot_policy: dict
+        :param VolumeIds: list[str] volumes to consider, all account volumes if not set
+        :param account_wide: bool use a single account-wide sweep instead of querying each volume
+        :param as_of: datetime reference time for every cutoff, now if not set
+        :return: (cucloud.retention.RetentionPlan, list[dict] snapshots the plan indexes into)
+        """
+        snapshot_tags = self._policy_snapshot_tags(snapshot_policy)
+
+        snapshots = []
+        tags = []
+        for snapshot_tag, snapshot in self._iter_tagged_snapshots(snapshot_tags, VolumeIds, account_wide):
+            snapshots.append(snapshot)
+            tags.append(snapshot_tag)
+
+        plan = retention.plan(snapshot_policy,
+                              [snapshot['SnapshotId'] for snapshot in snapshots],
+                              [snapshot['StartTime'] for snapshot in snapshots],
+                              tags,
+                              VolumeIds=[snapshot.get('VolumeId') for snapshot in snapshots],
+                              as_of=as_of)
+
+        return plan, snapshots
+
+    def find_old_snapshots(self, snapshot_policy=None, VolumeIds=None, account_wide=False, as_of=None):
+        """
+        :param snapshot_policy: dict
+        :param VolumeIds: list[str] volumes to consider, all account volumes if not set
+        :param account_wide: bool use a single account-wide sweep instead of querying each volume
+        :param as_of: datetime reference time for every cutoff, now if not set
+        :return: list[dict] oldest first
+        """
+        plan, snapshots = self.plan_old_snapshots(snapshot_policy=snapshot_policy, VolumeIds=VolumeIds,
+                                                  account_wide=account_wide, as_of=as_of)
+
+        return [snapshots[i] for i in plan.expired]
+
+    def _require_delete_scope(self, VolumeIds, account_wide):
+        # a missing VolumeIds would otherwise expire snapshots of every volume in the account
+        if VolumeIds is None and not account_wide:
+            raise ValueError('Deleting snapshots without VolumeIds requires account_wide=True')
+
+    def delete_old_snapshots(self, snapshot_policy=None, VolumeIds=None, account_wide=False):
+        """
+        :param snapshot_policy: dict
+        :param VolumeIds: list[str] volumes to consider
+        :param account_wide: bool required to consider every volume of the account when VolumeIds is not set
+        :return: list[dict] expired snapshots, a failed delete is printed and does not stop the others
+        """
+        self._require_delete_scope(VolumeIds, account_wide)
+
+        oldsnapshots = self.find_old_snapshots(snapshot_policy=snapshot_policy, VolumeIds=VolumeIds,
+                                               account_wide=account_wide)
 
         for snapshot in oldsnapshots:
             print "Snapshot: " + snapshot['SnapshotId'] + ", from: " + snapshot['StartTime'].isoformat() + ", descr: " + snapshot['Description']
-            self.delete_snapshot(snapshot['SnapshotId'])
+            try:
+                self.delete_snapshot(snapshot['SnapshotId'])
+            except Exception as e:
+                # e.g. InvalidSnapshot.InUse, still referenced by an AMI
+                print "Failed deleting: " + snapshot['SnapshotId'] + ": " + str(e)
 
-        return oldsnapshots
\ No newline at end of file
+        return oldsnapshots
+
+    def delete_old_snapshots_pipelined(self, snapshot_policy=None, VolumeIds=None, account_wide=False,
+                                       max_workers=4, queue_size=100):
+        """
+        Streaming delete: snapshots are handed to a pool of delete workers as describe_snapshots pages arrive,
+        memory stays bounded by queue_size instead of holding every expiring snapshot
+
+        :param VolumeIds: list[str] volumes to consider
+        :param account_wide: bool required to consider every volume of the account when VolumeIds is not set
+        :param max_workers: int number of delete worker threads
+        :param queue_size: int max snapshots waiting to be deleted
+        :return: dict with found, deleted, dry_run, failed counts, seconds and rate (deletes per second)
+        """
+        self._require_delete_scope(VolumeIds, account_wide)
+
+        pending = Queue.Queue(maxsize=queue_size)
+        stats = {'found': 0, 'deleted': 0, 'dry_run': 0, 'failed': 0}
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                snapshot = pending.get()
+                if snapshot is None:
+                    return
+
+                try:
+                    self._delete_snapshot(snapshot['SnapshotId'])
+                    outcome = 'deleted'
+                except Exception as e:
+                    if is_dry_run(e):
+                        print "DRY-RUN Deleting: " + snapshot['SnapshotId']
+                        outcome = 'dry_run'
+                    else:
+                        print "Failed deleting: " + snapshot['SnapshotId'] + ": " + str(e)
+                        outcome = 'failed'
+
+                with lock:
+                    stats[outcome] += 1
+
+        workers = [threading.Thread(target=worker) for _ in range(max(1, max_workers))]
+        for t in workers:
+            t.daemon = True
+            t.start()
+
+        start = time.time()
+        try:
+            for snapshot in self.iter_old_snapshots(snapshot_policy=snapshot_policy, VolumeIds=VolumeIds,
+                                                    account_wide=account_wide):
+                print "Snapshot: " + snapshot['SnapshotId'] + ", from: " + snapshot['StartTime'].isoformat() + ", descr: " + snapshot['Description']
+                stats['found'] += 1
+                # blocks while the queue is full
+                pending.put(snapshot)
+        finally:
+            for _ in workers:
+                pending.put(None)
+            for t in workers:
+                t.join()
+
+        stats['seconds'] = time.time() - start
+        stats['rate'] = stats['deleted'] / stats['seconds'] if stats['seconds'] else 0.0
+
+        print "Deleted %d of %d snapshots (%d dry run, %d failed) in %.1fs, %.1f/s" % (
+            stats['deleted'], stats['found'], stats['dry_run'], stats['failed'], stats['seconds'], stats['rate'])
+
+        return stats
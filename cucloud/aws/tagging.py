@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+from botocore.exceptions import ClientError
+from cucloud.aws.errors import is_dry_run
+
+__author__ = 'emg33'
+
+
+class TagWriter(object):
+    """
+    Buffers pending EC2 tag writes, groups resources that share an identical tag set and
+    writes each group with as few CreateTags calls as possible (max_batch resources each).
+
+    A group is written once it reaches max_batch resources, everything buffered is written
+    max_delay seconds after the first pending write, on flush() and when used as a context manager.
+
+    Writes that fail are buffered again rather than dropped. A failure of a delayed write is raised
+    by the next flush().
+    """
+
+    def __init__(self, ec2client, max_batch=500, max_delay=5, dry_run=False):
+        """
+        :param ec2client: EC2.Client
+        :param max_batch: int resources per CreateTags call
+        :param max_delay: int seconds a write may stay buffered, None only flushes on size or flush()
+        """
+        self.ec2client = ec2client
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.dry_run = dry_run
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._timer = None
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, ResourceIds, Tags):
+        """
+        :param ResourceIds: list[str]
+        :param Tags: list[dict] Key/Value pairs
+        """
+        key = tuple(sorted((tag['Key'], tag['Value']) for tag in Tags))
+        if not key or not ResourceIds:
+            return
+
+        full = []
+        with self._lock:
+            group = self._pending.setdefault(key, [])
+            group.extend(ResourceIds)
+
+            while len(group) >= self.max_batch:
+                full.append((key, group[:self.max_batch]))
+                del group[:self.max_batch]
+            if not group:
+                del self._pending[key]
+
+            if self._pending and self.max_delay is not None and not self._timer:
+                self._timer = threading.Timer(self.max_delay, self._flush_on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+        for key, ResourceIds in full:
+            try:
+                self._create_tags(key, ResourceIds)
+            except Exception:
+                self._requeue(key, ResourceIds)
+                raise
+
+    def pending(self):
+        """
+        :return: int number of buffered resource tag writes
+        """
+        with self._lock:
+            return sum(len(group) for group in self._pending.values())
+
+    def flush(self):
+        """
+        write everything buffered, every group is tried even if an earlier one fails.
+        Failed writes stay buffered and the first error (or that of an earlier delayed write) is raised.
+
+        :return: int number of CreateTags calls made
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            error = self._error
+            self._error = None
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+        calls, write_error = self._write(pending)
+        if error is None:
+            error = write_error
+        if error is not None:
+            raise error
+
+        return calls
+
+    def _write(self, pending):
+        calls = 0
+        error = None
+        for key, ResourceIds in pending.items():
+            for i in range(0, len(ResourceIds), self.max_batch):
+                batch = ResourceIds[i:i + self.max_batch]
+                calls += 1
+                try:
+                    self._create_tags(key, batch)
+                except Exception as e:
+                    logging.error('Tag write of %d resource(s) failed: %s', len(batch), e)
+                    self._requeue(key, batch)
+                    if error is None:
+                        error = e
+
+        return calls, error
+
+    def _requeue(self, key, ResourceIds):
+        # buffered again for the next flush, no timer is started so a persistent error does not loop
+        with self._lock:
+            self._pending.setdefault(key, []).extend(ResourceIds)
+
+    def _flush_on_timer(self):
+        with self._lock:
+            self._timer = None
+            pending = self._pending
+            self._pending = {}
+
+        calls, error = self._write(pending)
+        if error is not None:
+            with self._lock:
+                # kept for the next flush(), nobody waits on the timer thread
+                if self._error is None:
+                    self._error = error
+
+    def _create_tags(self, key, ResourceIds):
+        try:
+            self.ec2client.create_tags(
+                Resources=ResourceIds,
+                Tags=[{'Key': k, 'Value': v} for k, v in key],
+                DryRun=self.dry_run
+            )
+        except ClientError as e:
+            if not is_dry_run(e):
+                raise
+            print "DRY-RUN Tagging " + str(len(ResourceIds)) + " resource(s)"
+            return
+
+        print "Tagged " + str(len(ResourceIds)) + " resource(s) with " + ", ".join(k + '=' + v for k, v in key)
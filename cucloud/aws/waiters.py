@@ -0,0 +1,258 @@
+import abc
+import logging
+import threading
+import time
+from concurrent import futures
+
+__author__ = 'emg33'
+
+
+class _Watch(object):
+
+    def __init__(self, ids, target, failures, deadline, future):
+        self.ids = set(ids)
+        self.target = target
+        self.failures = failures
+        self.deadline = deadline
+        self.future = future
+
+
+class BatchPoller(object):
+    """
+    Background poller multiplexing many pending watches onto batched describe calls.
+    Subclasses implement _describe(ids) returning the current state of each id.
+
+    The interval starts at min_interval, grows by backoff while nothing changes
+    (up to max_interval) and drops back to min_interval as soon as something does.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, min_interval=2, max_interval=30, backoff=1.5, timeout=900):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self._lock = threading.Condition()
+        self._watches = []
+        self._states = {}
+        self._thread = None
+
+    @abc.abstractmethod
+    def _describe(self, ids):
+        """
+        :param ids: list[str]
+        :return: dict[str, str] state keyed by id, ids not (yet) visible may be left out
+        """
+        return
+
+    def _watch(self, ids, target, failures=(), callback=None, timeout=None):
+        """
+        :return: concurrent.futures.Future resolved with ids once all reached target
+        """
+        future = futures.Future()
+        future.set_running_or_notify_cancel()
+        if callback:
+            future.add_done_callback(callback)
+
+        ids = list(ids)
+        if not ids:
+            future.set_result(ids)
+            return future
+
+        if timeout is None:
+            timeout = self.timeout
+
+        with self._lock:
+            self._watches.append(_Watch(ids, target, failures, time.time() + timeout, future))
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._lock.notify()
+
+        return future
+
+    def _run(self):
+        interval = self.min_interval
+
+        while True:
+            with self._lock:
+                if not self._watches:
+                    self._thread = None
+                    return
+                watches = list(self._watches)
+
+            ids = set()
+            for watch in watches:
+                ids.update(watch.ids)
+
+            try:
+                states = self._describe(sorted(ids))
+            except Exception as e:
+                logging.warning('Polling failed, will retry: %s', e)
+                states = {}
+
+            changed = any(self._states.get(i) != state for i, state in states.items())
+            self._states.update(states)
+
+            with self._lock:
+                for watch in watches:
+                    self._settle(watch)
+                self._watches = [w for w in self._watches if not w.future.done()]
+                # forget states nobody waits for anymore
+                waiting = set()
+                for watch in self._watches:
+                    waiting.update(watch.ids)
+                self._states = dict((i, s) for i, s in self._states.items() if i in waiting)
+
+            if changed:
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+
+            with self._lock:
+                if not self._watches:
+                    self._thread = None
+                    return
+                # new watches wake us up early
+                self._lock.wait(interval)
+
+    def _settle(self, watch):
+        states = [self._states.get(i) for i in watch.ids]
+
+        failed = [i for i in watch.ids if self._states.get(i) in watch.failures]
+        if failed:
+            watch.future.set_exception(
+                Exception('Reached ' + ', '.join(sorted(set(self._states[i] for i in failed)))
+                          + ' instead of ' + watch.target + ': ' + ', '.join(sorted(failed))))
+        elif all(state == watch.target for state in states):
+            watch.future.set_result(sorted(watch.ids))
+        elif time.time() > watch.deadline:
+            watch.future.set_exception(
+                Exception('Timed out waiting for ' + watch.target + ': ' + ', '.join(sorted(watch.ids))))
+
+
+class InstanceStateWaiter(BatchPoller):
+    """
+    Waits for any number of instance sets at once, polling all of them with a single batched
+    describe_instances per interval instead of one blocking waiter per set.
+    """
+
+    # states that mean the target can no longer be reached, same as the botocore waiters
+    FAILURE_STATES = {
+        'running': ('shutting-down', 'terminated', 'stopping'),
+        'stopped': ('pending', 'terminated'),
+        'terminated': ('pending', 'stopping'),
+    }
+
+    def __init__(self, ec2client, **kwargs):
+        """
+        :param ec2client: EC2.Client
+        """
+        super(InstanceStateWaiter, self).__init__(**kwargs)
+        self.ec2client = ec2client
+
+    def _describe(self, ids):
+        states = {}
+
+        # an instance-id filter leaves out unknown ids instead of failing the whole call (InstanceIds=...
+        # raises InvalidInstanceID.NotFound), so a bad or not yet visible id only stalls its own watch
+        # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Paginator.DescribeInstances
+        paginator = self.ec2client.get_paginator('describe_instances')
+        for i in range(0, len(ids), 200):
+            for page in paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': ids[i:i + 200]}]):
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        states[instance['InstanceId']] = instance['State']['Name']
+
+        return states
+
+    def watch(self, InstanceIds, state, callback=None, timeout=None):
+        """
+        :param InstanceIds: list[str]
+        :param state: str target state, e.g. running, stopped
+        :param callback: callable called with the future once done
+        :param timeout: int seconds, default self.timeout
+        :return: concurrent.futures.Future resolved with the instance ids
+        """
+        return self._watch(InstanceIds, state, failures=self.FAILURE_STATES.get(state, ()),
+                           callback=callback, timeout=timeout)
+
+
+class SnapshotTracker(BatchPoller):
+    """
+    Tracks completion of any number of snapshots, polling State/Progress of all of them with
+    batched describe_snapshots calls (up to 200 ids each) instead of a waiter per snapshot.
+    """
+
+    def __init__(self, ec2client, min_interval=5, max_interval=60, timeout=6 * 3600, **kwargs):
+        """
+        :param ec2client: EC2.Client
+        """
+        super(SnapshotTracker, self).__init__(min_interval=min_interval, max_interval=max_interval,
+                                              timeout=timeout, **kwargs)
+        self.ec2client = ec2client
+        # last seen progress, e.g. '45%', keyed by SnapshotId
+        self.progress = {}
+        # (SnapshotId, future) of every tracked snapshot not yet returned by wait_all()
+        self._futures = []
+
+    def _describe(self, ids):
+        states = {}
+
+        # a snapshot-id filter leaves out unknown ids instead of failing the whole call (SnapshotIds=...
+        # raises InvalidSnapshot.NotFound), so a deleted or not yet visible snapshot only stalls its own watch
+        # http://boto3.readthedocs.org/en/latest/reference/services/ec2.html#EC2.Paginator.DescribeSnapshots
+        paginator = self.ec2client.get_paginator('describe_snapshots')
+        for i in range(0, len(ids), 200):
+            for page in paginator.paginate(Filters=[{'Name': 'snapshot-id', 'Values': ids[i:i + 200]}]):
+                for snapshot in page['Snapshots']:
+                    states[snapshot['SnapshotId']] = snapshot['State']
+                    self.progress[snapshot['SnapshotId']] = snapshot.get('Progress')
+
+        return states
+
+    def track(self, SnapshotIds, callback=None, timeout=None):
+        """
+        :param SnapshotIds: list[str]
+        :param callback: callable called with each snapshot's future once it completed or failed
+        :param timeout: int seconds, default self.timeout
+        :return: list[concurrent.futures.Future] one per snapshot, resolved with [SnapshotId]
+        """
+        tracked = [self._watch([SnapshotId], 'completed', failures=('error',), callback=callback, timeout=timeout)
+                   for SnapshotId in SnapshotIds]
+
+        with self._lock:
+            self._futures.extend(zip(SnapshotIds, tracked))
+
+        return tracked
+
+    def wait_all(self, progress=None, report_interval=30):
+        """
+        block until every tracked snapshot completed or failed
+
+        :param progress: callable(done, total, progress) called every report_interval seconds
+        :return: dict with 'completed' and 'failed' SnapshotIds, 'errors' the failure reason keyed by SnapshotId
+        """
+        with self._lock:
+            tracked = list(self._futures)
+
+        pending = set(future for _, future in tracked)
+        while pending:
+            _, pending = futures.wait(pending, timeout=report_interval)
+            if progress:
+                progress(len(tracked) - len(pending), len(tracked), dict(self.progress))
+
+        result = {'completed': [], 'failed': [], 'errors': {}}
+        for SnapshotId, future in tracked:
+            if future.exception():
+                result['failed'].append(SnapshotId)
+                result['errors'][SnapshotId] = str(future.exception())
+            else:
+                result['completed'].extend(future.result())
+
+        with self._lock:
+            self._futures = [f for f in self._futures if f not in tracked]
+
+        return result
@@ -0,0 +1,89 @@
+from concurrent import futures
+
+__author__ = 'emg33'
+
+
+class WaveScheduler(object):
+    """
+    Rolling start/stop/reboot of many instances in waves of wave_size on top of Compute.
+
+    Up to max_in_flight waves are waited on at once (their waiters are multiplexed by
+    Compute.waiter). A new wave is only issued after an earlier one finished and passed
+    health_check, a failed wave or health check stops any further waves from being issued.
+
+    Instances stay in the running state through a reboot, so a reboot wave counts as finished
+    as soon as EC2 accepted it; rolling reboots therefore require a health_check to pace the waves.
+    """
+
+    ACTIONS = ('start', 'stop', 'reboot')
+
+    def __init__(self, compute, wave_size=10, max_in_flight=2, health_check=None):
+        """
+        :param compute: cucloud.aws.compute.Compute
+        :param wave_size: int instances per wave
+        :param max_in_flight: int waves waited on at once
+        :param health_check: callable taking a wave's instance ids, returning False to stop further waves
+        """
+        if wave_size < 1 or max_in_flight < 1:
+            raise ValueError('wave_size and max_in_flight must be at least 1')
+
+        self.compute = compute
+        self.wave_size = wave_size
+        self.max_in_flight = max_in_flight
+        self.health_check = health_check
+
+    def _issue(self, action, InstanceIds):
+        if action == 'start':
+            return self.compute.start_instances_async(InstanceIds)
+        elif action == 'stop':
+            return self.compute.stop_instances_async(InstanceIds)
+        return self.compute.reboot_instances_async(InstanceIds)
+
+    def run(self, action, InstanceIds):
+        """
+        :param action: str start, stop or reboot
+        :param InstanceIds: list[str]
+        :return: dict with 'completed', 'failed' and 'skipped' instance ids and number of 'waves' issued
+        """
+        if action not in self.ACTIONS:
+            raise ValueError('Unsupported action', action)
+        if action == 'reboot' and not self.health_check:
+            raise ValueError('Rolling reboot requires a health_check, the instance state does not change on reboot')
+
+        InstanceIds = list(InstanceIds)
+        waves = [InstanceIds[i:i + self.wave_size] for i in range(0, len(InstanceIds), self.wave_size)]
+
+        summary = {'completed': [], 'failed': [], 'skipped': [], 'waves': 0}
+        in_flight = {}
+        halted = False
+
+        while in_flight or (waves and not halted):
+            while waves and not halted and len(in_flight) < self.max_in_flight:
+                wave = waves.pop(0)
+                print "Wave " + str(summary['waves'] + 1) + ": " + action + " " + ", ".join(wave)
+                in_flight[self._issue(action, wave)] = wave
+                summary['waves'] += 1
+
+            done, _ = futures.wait(list(in_flight), return_when=futures.FIRST_COMPLETED)
+
+            for future in done:
+                wave = in_flight.pop(future)
+
+                if future.exception():
+                    print "Wave failed, no further waves: " + str(future.exception())
+                    summary['failed'].extend(wave)
+                    halted = True
+                elif future.result() is False:
+                    # dry run, nothing happened
+                    summary['skipped'].extend(wave)
+                elif self.health_check and not self.health_check(wave):
+                    print "Wave failed health check, no further waves: " + ", ".join(wave)
+                    summary['failed'].extend(wave)
+                    halted = True
+                else:
+                    summary['completed'].extend(wave)
+
+        for wave in waves:
+            summary['skipped'].extend(wave)
+
+        return summary
@@ -0,0 +1,178 @@
+import threading
+import time
+from cucloud.aws import parallel
+
+__author__ = 'emg33'
+
+
+def normalize_name(name):
+    """
+    lower case name without the trailing dot, Route53 octal escapes such as \\052 (*) decoded
+
+    :param name: str
+    :return: str
+    """
+    name = name.lower().rstrip('.')
+    if '\\' in name:
+        name = name.replace('\\052', '*').replace('\\100', '@')
+    return name
+
+
+def normalize_target(target):
+    """
+    like normalize_name, alias targets to ELBs are reported with a dualstack. prefix that is dropped too
+
+    :param target: str
+    :return: str
+    """
+    target = normalize_name(target)
+    if target.startswith('dualstack.'):
+        target = target[len('dualstack.'):]
+    return target
+
+
+class ZoneIndex(object):
+    """
+    In-memory index of Route53 hosted zones and their record sets, loaded with paginated calls,
+    record sets of many zones fetched in parallel. Records are indexed by name, type and target
+    (resource record values and alias DNS names), so reverse lookups need no further API calls.
+
+    Requests stay within Route53's per account limit (5/s) through the registry's shared rate limiter.
+    """
+
+    def __init__(self, r53client, ttl=None, max_workers=4):
+        """
+        :param r53client: Route53.Client
+        :param ttl: int seconds before the index is considered stale, None only refreshes on refresh()
+        :param max_workers: int zones fetched at once
+        """
+        self.r53client = r53client
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.refreshed_at = None
+
+        self._lock = threading.Lock()
+        self._zones = []
+        self._records = []
+        self._by_zone = {}
+        self._by_name = {}
+        self._by_type = {}
+        self._by_target = {}
+
+    def _list_zones(self):
+        zones = []
+        # http://boto3.readthedocs.org/en/latest/reference/services/route53.html#Route53.Paginator.ListHostedZones
+        paginator = self.r53client.get_paginator('list_hosted_zones')
+        for page in paginator.paginate():
+            zones.extend(page['HostedZones'])
+        return zones
+
+    def _list_records(self, zone):
+        records = []
+        # http://boto3.readthedocs.org/en/latest/reference/services/route53.html#Route53.Paginator.ListResourceRecordSets
+        paginator = self.r53client.get_paginator('list_resource_record_sets')
+        for page in paginator.paginate(HostedZoneId=zone['Id']):
+            for record_set in page['ResourceRecordSets']:
+                record = dict(record_set)
+                record['HostedZoneId'] = zone['Id']
+                record['ZoneName'] = zone['Name']
+                records.append(record)
+        return records
+
+    def refresh(self):
+        """
+        :return: int number of record sets
+        """
+        zones = self._list_zones()
+
+        records = []
+        for zone_records, error in parallel.map_ordered(self._list_records, zones, self.max_workers):
+            if error:
+                # a partial index would answer reverse lookups wrongly
+                raise error
+            records.extend(zone_records)
+
+        by_zone = {}
+        by_name = {}
+        by_type = {}
+        by_target = {}
+        for record in records:
+            by_zone.setdefault(record['HostedZoneId'], []).append(record)
+            by_name.setdefault(normalize_name(record['Name']), []).append(record)
+            by_type.setdefault(record['Type'], []).append(record)
+
+            targets = set(normalize_target(r['Value']) for r in record.get('ResourceRecords', []))
+            if 'AliasTarget' in record:
+                targets.add(normalize_target(record['AliasTarget']['DNSName']))
+            for target in targets:
+                by_target.setdefault(target, []).append(record)
+
+        with self._lock:
+            self._zones = zones
+            self._records = records
+            self._by_zone = by_zone
+            self._by_name = by_name
+            self._by_type = by_type
+            self._by_target = by_target
+            self.refreshed_at = time.time()
+
+        return len(records)
+
+    def invalidate(self):
+        with self._lock:
+            self.refreshed_at = None
+
+    def is_stale(self):
+        if self.refreshed_at is None:
+            return True
+        return self.ttl is not None and time.time() - self.refreshed_at > self.ttl
+
+    def _ensure_fresh(self):
+        if self.is_stale():
+            self.refresh()
+
+    def zones(self):
+        """
+        :return: list[dict] hosted zones
+        """
+        self._ensure_fresh()
+        with self._lock:
+            return list(self._zones)
+
+    def records(self, name=None, record_type=None, zone_id=None):
+        """
+        :param name: str fully qualified name, trailing dot and case do not matter
+        :param record_type: str e.g. 'A', 'CNAME'
+        :param zone_id: str only records of this hosted zone
+        :return: list[dict] record sets, with HostedZoneId and ZoneName added
+        """
+        self._ensure_fresh()
+        with self._lock:
+            if name is not None:
+                records = self._by_name.get(normalize_name(name), [])
+            elif zone_id is not None:
+                records = self._by_zone.get(zone_id, [])
+            elif record_type is not None:
+                records = self._by_type.get(record_type, [])
+            else:
+                records = self._records
+
+        if zone_id is not None:
+            records = [record for record in records if record['HostedZoneId'] == zone_id]
+        if record_type is not None:
+            records = [record for record in records if record['Type'] == record_type]
+        return list(records)
+
+    def records_pointing_to(self, target, record_type=None):
+        """
+        reverse lookup, e.g. which records point at this ELB
+
+        :param target: str record value or alias DNS name, e.g. an ELB DNSName or an IP address
+        :param record_type: str only records of this type
+        :return: list[dict] record sets
+        """
+        self._ensure_fresh()
+        with self._lock:
+            records = self._by_target.get(normalize_target(target), [])
+
+        return [record for record in records if record_type is None or record['Type'] == record_type]
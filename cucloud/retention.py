@@ -0,0 +1,152 @@
+import bisect
+import calendar
+import datetime
+from dateutil.relativedelta import relativedelta
+from dateutil.tz import tzlocal
+
+__author__ = 'emg33'
+
+# relativedelta argument for each snapshot tag
+POLICY_UNITS = {'hourly': 'hours',
+                'daily': 'days',
+                'weekly': 'weeks',
+                'monthly': 'months',
+                'yearly': 'years'}
+
+
+def old_dttm(snapshot_tag, policy_value, now_dttm=None):
+    """
+    :param snapshot_tag: str
+    :param policy_value: int number of snapshot_tag units to keep
+    :param now_dttm: datetime reference time, now if not set
+    :return: datetime snapshots started at or before are old
+    """
+    if now_dttm is None:
+        # set a timezone to avoid any issues comparing with AWS timestamps
+        now_dttm = datetime.datetime.now(tzlocal())
+
+    return now_dttm - relativedelta(**{POLICY_UNITS[snapshot_tag]: policy_value})
+
+
+def to_epoch(dttm):
+    """
+    :param dttm: datetime (timezone aware) or number already in epoch seconds
+    :return: float epoch seconds
+    """
+    if isinstance(dttm, datetime.datetime):
+        return calendar.timegm(dttm.utctimetuple()) + dttm.microsecond / 1e6
+    return float(dttm)
+
+
+class RetentionPlan(object):
+    """
+    Result of evaluating a snapshot policy at a fixed as-of time, the same inputs always give the same plan.
+
+    expired holds indexes into the evaluated records, oldest first (ties ordered by snapshot id).
+    """
+
+    def __init__(self, snapshot_policy, as_of, cutoffs, SnapshotIds, VolumeIds, expired, total):
+        self.snapshot_policy = snapshot_policy
+        self.as_of = as_of
+        # snapshot tag -> datetime cutoff, 'all' for keep none, None for keep all
+        self.cutoffs = cutoffs
+        self.expired = expired
+        self.total = total
+
+        self._SnapshotIds = SnapshotIds
+        self._VolumeIds = VolumeIds
+
+    def __len__(self):
+        return len(self.expired)
+
+    def __iter__(self):
+        return iter(self.snapshot_ids())
+
+    def snapshot_ids(self):
+        """
+        :return: list[str] SnapshotIds to expire, oldest first
+        """
+        return [self._SnapshotIds[i] for i in self.expired]
+
+    def by_volume(self):
+        """
+        :return: dict VolumeId -> list[str] SnapshotIds to expire, oldest first
+        """
+        volumes = {}
+        if self._VolumeIds is None:
+            return volumes
+
+        for i in self.expired:
+            volumes.setdefault(self._VolumeIds[i], []).append(self._SnapshotIds[i])
+        return volumes
+
+    def to_dict(self):
+        """
+        :return: dict JSON serializable plan
+        """
+        cutoffs = {}
+        for snapshot_tag, cutoff in self.cutoffs.items():
+            cutoffs[snapshot_tag] = cutoff.isoformat() if isinstance(cutoff, datetime.datetime) else cutoff
+
+        return {'as_of': self.as_of.isoformat(),
+                'snapshot_policy': self.snapshot_policy,
+                'cutoffs': cutoffs,
+                'total': self.total,
+                'expire': self.snapshot_ids()}
+
+
+def plan(snapshot_policy, SnapshotIds, StartTimes, Tags, VolumeIds=None, as_of=None):
+    """
+    Evaluate a snapshot policy for a batch of snapshot records given as parallel lists.
+
+    Records are grouped by tag and each group sorted once by start time, the expiring records of a group
+    are then the prefix found by bisecting its cutoff, so cost is O(n log n) regardless of volume count.
+
+    :param snapshot_policy: dict e.g. {'daily': 4, 'weekly': 3, 'monthly': 6, 'yearly': -1}
+    :param SnapshotIds: list[str]
+    :param StartTimes: list[datetime] or list[float] epoch seconds
+    :param Tags: list[str] cucloud-snapshot tag of each record, None if untagged
+    :param VolumeIds: list[str] optional, used by RetentionPlan.by_volume()
+    :param as_of: datetime single reference time for every cutoff, now if not set
+    :return: RetentionPlan
+    """
+    total = len(SnapshotIds)
+    if len(StartTimes) != total or len(Tags) != total or (VolumeIds is not None and len(VolumeIds) != total):
+        raise ValueError('Snapshot record lists must have the same length')
+
+    if as_of is None:
+        as_of = datetime.datetime.now(tzlocal())
+
+    epochs = [to_epoch(StartTime) for StartTime in StartTimes]
+
+    def order(i):
+        return epochs[i], SnapshotIds[i]
+
+    groups = {}
+    for i, snapshot_tag in enumerate(Tags):
+        if snapshot_tag:
+            groups.setdefault(snapshot_tag.lower(), []).append(i)
+
+    cutoffs = {}
+    expired = []
+    for snapshot_tag, policy_value in snapshot_policy.items():
+        if policy_value == 0:
+            # keep all
+            cutoffs[snapshot_tag] = None
+            continue
+
+        indexes = sorted(groups.get(snapshot_tag, []), key=order)
+        if policy_value == -1:
+            # keep none
+            cutoffs[snapshot_tag] = 'all'
+            expired.extend(indexes)
+            continue
+
+        cutoff = old_dttm(snapshot_tag, policy_value, now_dttm=as_of)
+        cutoffs[snapshot_tag] = cutoff
+        count = bisect.bisect_right([epochs[i] for i in indexes], to_epoch(cutoff))
+        expired.extend(indexes[:count])
+
+    expired.sort(key=order)
+
+    return RetentionPlan(snapshot_policy, as_of, cutoffs, SnapshotIds, VolumeIds, expired, total)
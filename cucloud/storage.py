@@ -1,6 +1,6 @@
 import abc
 import datetime
-from dateutil.relativedelta import *
+from cucloud import retention
 from dateutil.tz import *
 
 __author__ = 'emg33'
@@ -47,27 +47,18 @@ class StorageBase(object):
             raise ValueError('Invalid snapshot policy', snapshot_policy)
         return True
 
-    def get_old_dttm(self, snapshot_tag, policy_value):
-        # set to UTC to avoid any issues
-        if snapshot_tag == 'hourly':
-            d = relativedelta(hours=policy_value)
-        elif snapshot_tag == 'daily':
-            d = relativedelta(days=policy_value)
-        elif snapshot_tag == 'weekly':
-            d = relativedelta(weeks=policy_value)
-        elif snapshot_tag == 'monthly':
-            d = relativedelta(months=policy_value)
-        elif snapshot_tag == 'yearly':
-            d = relativedelta(years=policy_value)
-
-        now_dttm = datetime.datetime.now(tzlocal())
-        consider_old_dttm = now_dttm - d
-
-        return consider_old_dttm
+    def get_old_dttm(self, snapshot_tag, policy_value, now_dttm=None):
+        """
+        :param now_dttm: datetime reference time, pass the same value for every tag of one evaluation
+        :return: datetime snapshots started at or before are old
+        """
+        return retention.old_dttm(snapshot_tag, policy_value, now_dttm=now_dttm)
 
     def explain_snapshot_policy(self, snapshot_policy):
         self.verify_snapshot_policy(snapshot_policy)
 
+        now_dttm = datetime.datetime.now(tzlocal())
+
         print "Using snapshot policy:"
         # print snapshot_policy
         for snapshot_tag in ['daily', 'weekly', 'monthly', 'yearly']:
@@ -77,7 +68,7 @@ class StorageBase(object):
             elif policy_value == -1:
                 print "Keep no '" + snapshot_tag + "' snapshots"
             else:
-                old_dttm = self.get_old_dttm(snapshot_tag, policy_value)
+                old_dttm = self.get_old_dttm(snapshot_tag, policy_value, now_dttm=now_dttm)
                 print "Delete '" + snapshot_tag + "' snapshots older than " + str(policy_value) + " (" + old_dttm.isoformat() + ")"
 
     def create_snapshot_policy(self, daily=0, weekly=0, monthly=0, yearly=0):